@@ -5,7 +5,7 @@
 .. include:: ../../Readme.md
 '''
 
-from ttemtoolbox.core import process_ttem, process_gamma, process_well, process_water, lithology_connect, rock_trans
+from ttemtoolbox.core import process_ttem, process_gamma, process_well, process_water, lithology_connect, rock_trans, water_store, water_table
 from ttemtoolbox.utils import tools
 from ttemtoolbox._version import __version__
 from ttemtoolbox import main
@@ -1,74 +1,150 @@
-import ttemtoolbox as tt
+#!/usr/bin/env python
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from ttemtoolbox.core import lithology_connect
+from ttemtoolbox.core.process_well import ProcessWell
 
-def value_search(ttem_data_df, welllog, WIN, rho_fine=10, rho_coarse=25,step=1, loop_range=20,correct=False):
-    #progress = Bar('Processing', max=100)
-    import itertools
+def _load_welllog(welllog):
     if isinstance(welllog,(str, pathlib.PurePath)):
-        welllog_df = tt.core.process_well.ProcessWell(welllog)
-        welllog_df = welllog_df.upscale(100)
+        well = ProcessWell(welllog)
+        return well.resample(100)
     elif isinstance(welllog, pd.DataFrame):
-        welllog_df = welllog
-    welllog_WIN = welllog_df[welllog_df['Bore']==str(WIN)]
-    try:
-        ttem_data = closest_rock(ttem_data_df, welllog_WIN)
-    except ttem_data.empty:
-         raise ('No match Well log')
-    fine_range = np.arange(rho_fine, rho_fine + (step * loop_range), step)
-    coarse_range = np.arange(rho_coarse, rho_coarse + (step * loop_range), step)
-    resistivity_list = list(itertools.product(fine_range, coarse_range))
-    #Resi_conf_df = pd.DataFrame({'Fine_conf': [0, fine_rho], 'Mix_conf': [fine_rho, coarse_rho], 'Coarse_conf': [coarse_rho, 300]})
+        return welllog
+    raise TypeError('welllog has to be either a path or DataFrame not {}'.format(type(welllog)))
+
+def _merge_well(welllog_WIN, ttem_data, correct=False):
+    welllog_WIN = welllog_WIN.copy()
     welllog_WIN['Elevation_top'] = welllog_WIN['Elevation_top'].round(2)
     if correct is True:
         elevation_diff = welllog_WIN['Elevation_top'].iloc[0] - ttem_data['Elevation_Cell'].iloc[0]
         welllog_WIN['Elevation_top'] =welllog_WIN['Elevation_top'].subtract(elevation_diff)
         welllog_WIN['Elevation_bottom'] = welllog_WIN['Elevation_bottom'].subtract(elevation_diff)
-    reslist = ['']*len(resistivity_list)
-    corrlist = ['']*len(resistivity_list)
-    i = 0
-    for rho_fine, rho_coarse in resistivity_list:
-        Resi_conf_df = pd.DataFrame(
-            {'Fine_conf': [0, rho_fine],
-             'Mix_conf': [rho_fine, rho_coarse],
-             'Coarse_conf': [rho_coarse, 300]})
-        reslist[i] = [rho_fine, rho_coarse]
-        rk_trans = tt.core.Rock_trans.rock_transform(ttem_data, Resi_conf_df)
-        merge = pd.merge(welllog_WIN, rk_trans, left_on=['Elevation_top'], right_on=['Elevation_Cell'])
-        #corr = merge['Keyword_n'].corr(merge['Identity_n'])
-        corr2 = (merge['Keyword_n'] == merge['Identity_n']).sum()/len(merge['Keyword_n'])
-        #corrlist.append(corr)
-        corrlist[i]=corr2
-        i += 1
-    def fine_best_corr(reslist, corrlist):
-        corrlist = [np.nan_to_num(x) for x in corrlist]
-        best_corr = max(corrlist)
-        match_list = [i for i, x in enumerate(corrlist) if x == best_corr]
-        resistivity_list = [reslist[i] for i in match_list]
-        resistivity_coarse_gt_fine = [i for i in resistivity_list if i[1]>i[0]]
-        res_bkup_incase_empty = np.array(resistivity_list)
-        resistivity_array = np.array(resistivity_coarse_gt_fine)
-        if resistivity_array.size > 0:
-            fine_grained_rho_mean = resistivity_array[:,0].mean()
-            coarse_grained_rho_mean = resistivity_array[:,1].mean()
-            export_result = {'similiarity':best_corr,'Fine_conf':fine_grained_rho_mean,'Coarse_conf':coarse_grained_rho_mean}
-            return export_result
-        else:
-            coarse_grained_rho_mean = res_bkup_incase_empty[:, 1].mean()
-            fine_grained_rho_mean = coarse_grained_rho_mean
+    return pd.merge(welllog_WIN, ttem_data, left_on=['Elevation_top'], right_on=['Elevation_Cell'])
+
+def _prepare_merge(ttem_data_df, welllog, WIN, correct=False):
+    """
+    Select the well log of WIN and the tTEM sounding closest to it, and merge them on elevation. This is done once
+    per search, every threshold combination is evaluated on the merged arrays.
+    :return: merged dataframe of well log and tTEM rows
+    """
+    welllog_df = _load_welllog(welllog)
+    welllog_WIN = welllog_df[welllog_df['Bore']==str(WIN)]
+    if welllog_WIN.empty:
+        raise ValueError('No well log found for {}'.format(WIN))
+    match, order = lithology_connect.match_soundings(ttem_data_df, welllog_WIN)
+    ttem_data = ttem_data_df.iloc[order[match['start'].iloc[0]:match['stop'].iloc[0]]]
+    if ttem_data.empty:
+        raise ValueError('No tTEM sounding matched well {}'.format(WIN))
+    return _merge_well(welllog_WIN, ttem_data, correct)
 
-            export_result = {'similiarity': best_corr, 'Fine_conf': fine_grained_rho_mean,
-                             'Coarse_conf': coarse_grained_rho_mean}
-            return export_result
-    #resi_conf_df1, best1 = fine_best_corr(reslist, corrlist)
-    best= fine_best_corr(reslist, corrlist)
+def _similarity_grid(resistivity, keyword_n, fine_range, coarse_range):
+    """
+    Share of rows where the rock_transform class of (rho_fine, rho_coarse) equals the well log class, for the whole
+    fine x coarse grid at once. A row is fine when resistivity <= rho_fine, coarse when it is > rho_fine and
+    >= rho_coarse, mix otherwise; the hits of each class are counted from its sorted resistivity with searchsorted.
+    :return: (len(fine_range), len(coarse_range)) array
+    """
+    fine = np.asarray(fine_range, dtype='float64')[:, None]
+    coarse = np.asarray(coarse_range, dtype='float64')[None, :]
+    fine_res, mix_res, coarse_res = [np.sort(resistivity[keyword_n == n]) for n in (1, 2, 3)]
+    fine_hit = np.searchsorted(fine_res, fine, side='right')
+    mix_hit = np.clip(np.searchsorted(mix_res, coarse, side='left') - np.searchsorted(mix_res, fine, side='right'),
+                      0, None)
+    coarse_hit = len(coarse_res) - np.where(coarse > fine,
+                                            np.searchsorted(coarse_res, coarse, side='left'),
+                                            np.searchsorted(coarse_res, fine, side='right'))
+    return (fine_hit + mix_hit + coarse_hit) / len(resistivity)
 
-    #progress.finish()
+def _best_similarity(fine_range, coarse_range, similarity):
+    # average all the best combinations, prefer the ones with rho_coarse > rho_fine
+    similarity = np.nan_to_num(similarity)
+    best_corr = similarity.max()
+    fine, coarse = np.meshgrid(fine_range, coarse_range, indexing='ij')
+    best = similarity == best_corr
+    coarse_gt_fine = best & (coarse > fine)
+    if coarse_gt_fine.any():
+        fine_grained_rho_mean = fine[coarse_gt_fine].mean()
+        coarse_grained_rho_mean = coarse[coarse_gt_fine].mean()
+    else:
+        coarse_grained_rho_mean = coarse[best].mean()
+        fine_grained_rho_mean = coarse_grained_rho_mean
+    return {'similiarity': best_corr, 'Fine_conf': fine_grained_rho_mean, 'Coarse_conf': coarse_grained_rho_mean}
+
+def value_search(ttem_data_df, welllog, WIN, rho_fine=10, rho_coarse=25,step=1, loop_range=20,correct=False,
+                 return_grid=False):
+    """
+    Search the fine/coarse resistivity thresholds that best reproduce the well log classes of WIN, the similiarity
+    is the share of merged rows where the transformed class equals the well log class.
+    :param ttem_data_df: tTEM resistivity profile
+    :param welllog: well log data or path to the well log file
+    :param WIN: The WIN number of the well log
+    :param rho_fine: start of the fine-grained threshold range
+    :param rho_coarse: start of the coarse-grained threshold range
+    :param step: step of the ranges, can be fractional
+    :param loop_range: number of steps of each range
+    :param correct: shift the well log to the elevation of the tTEM sounding
+    :param return_grid: also return the ranges and the full similiarity grid
+    :return: dict of the best similiarity and the averaged thresholds (and the grid)
+    """
+    merge = _prepare_merge(ttem_data_df, welllog, WIN, correct)
+    fine_range = np.arange(rho_fine, rho_fine + (step * loop_range), step)
+    coarse_range = np.arange(rho_coarse, rho_coarse + (step * loop_range), step)
+    similarity = _similarity_grid(merge['Resistivity'].to_numpy(dtype='float64'),
+                                  merge['Keyword_n'].to_numpy(dtype='int64'), fine_range, coarse_range)
+    best = _best_similarity(fine_range, coarse_range, similarity)
+    if return_grid:
+        return best, {'fine': fine_range, 'coarse': coarse_range, 'similiarity': similarity}
     return best
+
+def _pearson_grid(resistivity, keyword_n, fine_range, mix_range, coarse_range):
+    """
+    Pearson correlation between resistivity and the well log classes mapped to (rho_fine, rho_mix, rho_coarse), for
+    the whole fine x mix x coarse grid at once. Rows outside the three classes map to 0 as in np.select, so the
+    correlation only depends on the class counts and the per-class sums of the centered resistivity.
+    :return: (len(fine_range), len(mix_range), len(coarse_range)) array, nan where the mapping is constant
+    """
+    resistivity = resistivity - resistivity.mean()
+    count = np.array([(keyword_n == n).sum() for n in (1, 2, 3)], dtype='float64')
+    total = np.array([resistivity[keyword_n == n].sum() for n in (1, 2, 3)])
+    fine = np.asarray(fine_range, dtype='float64')[:, None, None]
+    mix = np.asarray(mix_range, dtype='float64')[None, :, None]
+    coarse = np.asarray(coarse_range, dtype='float64')[None, None, :]
+    sum_x = count[0] * fine + count[1] * mix + count[2] * coarse
+    sum_xx = count[0] * fine ** 2 + count[1] * mix ** 2 + count[2] * coarse ** 2
+    sum_xy = total[0] * fine + total[1] * mix + total[2] * coarse
+    var_x = sum_xx - sum_x ** 2 / len(resistivity)
+    var_y = (resistivity ** 2).sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pearson = sum_xy / np.sqrt(np.clip(var_x, 0, None) * var_y)
+    pearson[var_x <= 1e-12 * sum_xx] = np.nan
+    return pearson
+
+def _best_pearson(fine_range, mix_range, coarse_range, pearson):
+    # average all the best combinations, prefer the ones with rho_coarse > rho_fine
+    pearson = np.nan_to_num(pearson)
+    best = pearson.max()
+    fine, mix, coarse = np.meshgrid(fine_range, mix_range, coarse_range, indexing='ij')
+    match = np.isclose(pearson, best, rtol=1e-9, atol=1e-12)
+    coarse_gt_fine = match & (coarse > fine)
+    if coarse_gt_fine.any():
+        fine_rho_avg = fine[coarse_gt_fine].mean()
+        mix_rho_avg = mix[coarse_gt_fine].mean()
+        coarse_rho_avg = coarse[coarse_gt_fine].mean()
+    else:
+        mix_rho_avg = mix[match].mean()
+        coarse_rho_avg = coarse[match].mean()
+        fine_rho_avg = coarse_rho_avg
+    return {'pearson':best,'Fine_average':fine_rho_avg,'Mix_average':mix_rho_avg,'Coarse_average':coarse_rho_avg,}
+
 def value_search_res(ttem_data_df, welllog, WIN,
                      rho_fine:float=10,
                      rho_mix:float=15,
                      rho_coarse:float=25,
                      step:int=1,
-                     loop_range:int=20,correct=False):
+                     loop_range:int=20,correct=False,
+                     return_grid=False):
     """
     Assign each lithology type as corresponsing resistivity and run pearson correlation to fine the best resistiviry overall
     :param ttem_data_df: tTEM resistivity profile
@@ -79,67 +155,95 @@ def value_search_res(ttem_data_df, welllog, WIN,
     :param rho_coarse: resistivity of coarse-grained material
     :param step: loop of each step
     :param loop_range: the total range of the loop
-    :return:
+    :param correct: shift the well log to the elevation of the tTEM sounding
+    :param return_grid: also return the ranges and the full pearson cube
+    :return: dict of the best pearson and the averaged resistivities (and the cube)
     """
-    import itertools
-    pd.options.mode.chained_assignment = None
-    if isinstance(welllog,(str, pathlib.PurePath)):
-        welllog_df = tt.core.process_well.ProcessWell(welllog)
-        welllog_df = welllog_df.upscale(100)
-    elif isinstance(welllog, pd.DataFrame):
-        welllog_df = welllog
-    welllog_WIN = welllog_df[welllog_df['Bore']==str(WIN)]
-    welllog_WIN.fillna('',inplace=True)
-    try:
-        ttem_data = closest_rock(ttem_data_df, welllog_WIN)
-    except ttem_data.empty:
-         raise ('well log expty')
-    welllog_WIN['Elevation_top'] = welllog_WIN['Elevation_top'].round(2)
-    if correct is True:
-        elevation_diff = welllog_WIN['Elevation_top'].iloc[0] - ttem_data['Elevation_Cell'].iloc[0]
-        welllog_WIN['Elevation_top'] =welllog_WIN['Elevation_top'].subtract(elevation_diff)
-        welllog_WIN['Elevation_bottom'] = welllog_WIN['Elevation_bottom'].subtract(elevation_diff)
-
+    merge = _prepare_merge(ttem_data_df, welllog, WIN, correct)
     fine_range = np.arange(rho_fine, rho_fine+(step*loop_range), step)
     mix_range = np.arange(rho_mix, rho_mix+(step*loop_range), step)
     coarse_range = np.arange(rho_coarse, rho_coarse+(step*loop_range), step)
-    resistivity_list = list(itertools.product(fine_range, mix_range, coarse_range))
-    corr_list = ['']*len(resistivity_list)
-    i=0
-    #total = len(resistivity_list)
-    #count = 0
-
-    merge = pd.merge(welllog_WIN, ttem_data, left_on=['Elevation_top'], right_on=['Elevation_Cell'])
-    choicelist = [merge['Keyword_n'] == 1, merge['Keyword_n'] == 2, merge['Keyword_n'] == 3]
-    for rho_fine, rho_mix, rho_coarse in resistivity_list:
+    pearson = _pearson_grid(merge['Resistivity'].to_numpy(dtype='float64'),
+                            merge['Keyword_n'].to_numpy(dtype='int64'), fine_range, mix_range, coarse_range)
+    best = _best_pearson(fine_range, mix_range, coarse_range, pearson)
+    if return_grid:
+        return best, {'fine': fine_range, 'mix': mix_range, 'coarse': coarse_range, 'pearson': pearson}
+    return best
 
-        choicelist2 = [rho_fine, rho_mix, rho_coarse]
-        welllog_resistivity = np.select(choicelist, choicelist2)
-        corr = np.corrcoef(welllog_resistivity, merge['Resistivity'])[0,1]
-        corr_list[i]=corr
-        i+=1
-        #count = count + 1
-        #print('{}/{}'.format(count, total))
-    def best_corr(reslist, corrlist):
-        corrlist = [np.nan_to_num(x) for x in corrlist]
-        best = max(corrlist)
-        match_list = [i for i, x in enumerate(corrlist) if x == best]
-        resistivity_list = [reslist[i] for i in match_list]
-        resistivity_coarse_gt_fine = [i for i in resistivity_list if i[2] > i[0]]
-        res_bkup_incase_empty = np.array(resistivity_list)
-        resistivity_array = np.array(resistivity_coarse_gt_fine)
-        if resistivity_array.size > 0:
-            fine_rho_avg = resistivity_array[:,0].mean()
-            mix_rho_avg = resistivity_array[:,1].mean()
-            coarse_rho_avg = resistivity_array[:,2].mean()
-            export_result = {'pearson':best,'Fine_average':fine_rho_avg,'Mix_average':mix_rho_avg,'Coarse_average':coarse_rho_avg,}
-            return export_result
-        else:
+def _search_well(task):
+    """
+    Run the searches of one well on its merged arrays, module level so it can be sent to a process pool.
+    """
+    resistivity, keyword_n, method, ranges = task
+    result = {}
+    if method in ('similiarity', 'all'):
+        fine_range, coarse_range = ranges['fine'], ranges['coarse']
+        result.update(_best_similarity(fine_range, coarse_range,
+                                       _similarity_grid(resistivity, keyword_n, fine_range, coarse_range)))
+    if method in ('pearson', 'all'):
+        fine_range, mix_range, coarse_range = ranges['fine'], ranges['mix'], ranges['coarse']
+        result.update(_best_pearson(fine_range, mix_range, coarse_range,
+                                    _pearson_grid(resistivity, keyword_n, fine_range, mix_range, coarse_range)))
+    return result
 
-            mix_rho_avg = res_bkup_incase_empty[:, 1].mean()
-            coarse_rho_avg = res_bkup_incase_empty[:, 2].mean()
-            fine_rho_avg = coarse_rho_avg
-            export_result = {'pearson':best,'Fine_average':fine_rho_avg,'Mix_average':mix_rho_avg,'Coarse_average':coarse_rho_avg,}
-            return export_result
-    resi_conf_df = best_corr(resistivity_list, corr_list)
-    return resi_conf_df
\ No newline at end of file
+def batch_search(ttem_data_df, welllog, wins=None, method='all',
+                 rho_fine:float=10,
+                 rho_mix:float=15,
+                 rho_coarse:float=25,
+                 step:int=1,
+                 loop_range:int=20,
+                 correct=False,
+                 search_radius:float=None,
+                 workers:int=None):
+    """
+    Run value_search and/or value_search_res for many wells at once. The well log is loaded once, every bore is
+    matched to its closest sounding with a single KD-tree query, and the per-well searches run in a process pool
+    when workers > 1.
+    :param ttem_data_df: tTEM resistivity profile
+    :param welllog: well log data or path to the well log file
+    :param wins: WIN numbers to search, default None searches every bore in the well log
+    :param method: 'similiarity' (value_search), 'pearson' (value_search_res) or 'all'
+    :param rho_fine: start of the fine-grained range
+    :param rho_mix: start of the mix-grained range, only used by 'pearson'
+    :param rho_coarse: start of the coarse-grained range
+    :param step: step of the ranges
+    :param loop_range: number of steps of each range
+    :param correct: shift each well log to the elevation of its tTEM sounding
+    :param search_radius: skip wells without a sounding within search_radius, default None keeps all
+    :param workers: number of worker processes, default None runs in this process
+    :return: one row per well with Bore, distance, the number of merged layers and the best results
+    """
+    if method not in ('similiarity', 'pearson', 'all'):
+        raise ValueError("method has to be 'similiarity', 'pearson' or 'all' not {}".format(method))
+    welllog_df = _load_welllog(welllog)
+    if wins is not None:
+        welllog_df = welllog_df[welllog_df['Bore'].isin([str(win) for win in wins])]
+    if welllog_df.empty:
+        raise ValueError('No well log found for {}'.format(wins))
+    ranges = {'fine': np.arange(rho_fine, rho_fine + (step * loop_range), step),
+              'mix': np.arange(rho_mix, rho_mix + (step * loop_range), step),
+              'coarse': np.arange(rho_coarse, rho_coarse + (step * loop_range), step)}
+    match, order = lithology_connect.match_soundings(ttem_data_df, welllog_df, search_radius=search_radius)
+    well_groups = dict(list(welllog_df.groupby('Bore')))
+    rows, tasks = [], []
+    for bore, distance, within, start, stop in match[['Bore', 'distance', 'within', 'start', 'stop']].itertuples(
+            index=False):
+        if not within:
+            print('Skip {} because the closest sounding is {:.0f}m away'.format(bore, distance))
+            continue
+        merge = _merge_well(well_groups[bore], ttem_data_df.iloc[order[start:stop]], correct)
+        if merge.empty:
+            print('Skip {} because no layer matched the tTEM elevation'.format(bore))
+            continue
+        rows.append({'Bore': bore, 'distance': distance, 'n_layer': len(merge)})
+        tasks.append((merge['Resistivity'].to_numpy(dtype='float64'),
+                      merge['Keyword_n'].to_numpy(dtype='int64'), method, ranges))
+    if workers is not None and workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_search_well, tasks,
+                                        chunksize=max(1, len(tasks) // (workers * 4))))
+    else:
+        results = [_search_well(task) for task in tasks]
+    output = pd.DataFrame([{**row, **result} for row, result in zip(rows, results)])
+    print('Searched {} of {} wells'.format(len(output), len(match)))
+    return output
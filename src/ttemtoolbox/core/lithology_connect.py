@@ -1,152 +1,486 @@
 #!/usr/bin/env python
 import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+from scipy.spatial import cKDTree
 from scipy.stats import pearsonr
 from ttemtoolbox.core.process_well import ProcessWell
+from ttemtoolbox.utils import tools
+
+def _concat_ranges(starts, stops):
+    # vectorized np.concatenate([np.arange(a, b) for a, b in zip(starts, stops)])
+    lengths = stops - starts
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+def _group_keys(code, value, *queries):
+    """
+    Composite keys that sort values by an int group code first and by value within the group: every group occupies
+    its own span of the number line, so one argsort/searchsorted handles all groups at once.
+    :param code: int group code of every value
+    :param value: float values
+    :param queries: (code, value) pairs to place on the same number line, e.g. searchsorted targets
+    :return: list of the keys of the values and of every query
+    """
+    pairs = [(code, value)] + list(queries)
+    finite = np.concatenate([np.asarray(v, dtype='float64').ravel() for _, v in pairs])
+    finite = finite[np.isfinite(finite)]
+    lowest = finite.min() if len(finite) else 0
+    span = finite.max() - lowest + 1 if len(finite) else 1
+    return [np.asarray(c) * span + (np.asarray(v, dtype='float64') - lowest) for c, v in pairs]
+
+def sounding_index(ttemdata: pd.DataFrame | gpd.GeoDataFrame):
+    """
+    Group tTEM rows by sounding location (X, Y) without a python loop.
+    :param ttemdata: tTEM dataframe
+    :return: sounding locations (n, 2), row order that groups the rows by sounding, and start/stop offsets of each \
+    sounding in that order, i.e. ttemdata.iloc[order[start:stop]] are the layers of one sounding
+    """
+    xy = ttemdata[['X', 'Y']].to_numpy(dtype='float64')
+    if len(xy) == 0:
+        return np.empty((0, 2)), np.empty(0, dtype='int64'), np.empty(0, dtype='int64'), np.empty(0, dtype='int64')
+    # ProcessTTEM output keeps the layers of a sounding together, use the runs directly when they are unique
+    change = np.flatnonzero((xy[1:] != xy[:-1]).any(axis=1)) + 1
+    starts = np.concatenate([[0], change])
+    stops = np.concatenate([change, [len(xy)]])
+    if len(np.unique(xy[starts], axis=0)) == len(starts):
+        return xy[starts], np.arange(len(xy)), starts, stops
+    sounding_xy, inverse = np.unique(xy, axis=0, return_inverse=True)
+    order = np.argsort(inverse.reshape(-1), kind='stable')
+    counts = np.bincount(inverse.reshape(-1), minlength=len(sounding_xy))
+    stops = np.cumsum(counts)
+    return sounding_xy, order, stops - counts, stops
+
+def match_soundings(ttemdata: pd.DataFrame | gpd.GeoDataFrame,
+                    welllog: pd.DataFrame | gpd.GeoDataFrame,
+                    search_radius: float = None,
+                    k: int | None = 1):
+    """
+    Match every bore to its closest tTEM sounding(s) with batched KD-tree queries.
+    :param ttemdata: tTEM dataframe
+    :param welllog: well log dataframe
+    :param search_radius: soundings further than search_radius are flagged as not within, default None keeps all
+    :param k: number of nearest soundings for each bore, None to gather every sounding within search_radius
+    :return: dataframe with one row per (bore, sounding) pair ordered by bore and distance, columns are Bore, \
+    distance, within, weight and the start/stop offsets of the sounding; and the row order from sounding_index, \
+    ttemdata.iloc[order[start:stop]] are the layers of a matched sounding. Bores without any sounding within \
+    search_radius keep their nearest sounding with within=False. weight is the inverse distance (floored at 1m) \
+    normalized to sum to 1 over the soundings within search_radius of each bore.
+    """
+    if k is None and search_radius is None:
+        raise ValueError('search_radius is required to gather all soundings within the radius')
+    sounding_xy, order, starts, stops = sounding_index(ttemdata)
+    bore_codes, bores = pd.factorize(welllog['Bore'], sort=True)
+    codes, first_row = np.unique(bore_codes, return_index=True)
+    first_row = first_row[codes >= 0] # rows without a Bore are ignored
+    well_xy = welllog[['X', 'Y']].to_numpy(dtype='float64')[first_row]
+    tree = cKDTree(sounding_xy)
+    if k is None:
+        neighbours = tree.query_ball_point(well_xy, r=float(search_radius))
+        counts = np.array([len(n) for n in neighbours], dtype='int64')
+        bore_index = np.repeat(np.arange(len(bores)), counts)
+        sounding = np.concatenate([np.asarray(n, dtype='int64') for n in neighbours]) if len(bores) > 0 \
+            else np.empty(0, dtype='int64')
+        # bores with nothing in the radius keep their nearest sounding for the skip report
+        lonely = np.flatnonzero(counts == 0)
+        _, lonely_sounding = tree.query(well_xy[lonely], k=1)
+        bore_index = np.concatenate([bore_index, lonely])
+        sounding = np.concatenate([sounding, np.asarray(lonely_sounding, dtype='int64')])
+        distance = np.hypot(*(sounding_xy[sounding] - well_xy[bore_index]).T)
+    else:
+        distance, sounding = tree.query(well_xy, k=k)
+        distance = distance.reshape(len(well_xy), -1)
+        sounding = sounding.reshape(len(well_xy), -1)
+        keep = np.isfinite(distance) # fewer soundings than k
+        bore_index = np.nonzero(keep)[0]
+        distance, sounding = distance[keep], sounding[keep]
+    sort = np.lexsort((distance, bore_index))
+    bore_index, sounding, distance = bore_index[sort], sounding[sort], distance[sort]
+    within = distance <= float(search_radius) if search_radius is not None else np.ones(len(distance), dtype=bool)
+    if k is not None:
+        # the nearest sounding is always kept so bores outside the radius can be reported
+        within_count = np.bincount(bore_index[within], minlength=len(bores))
+        nearest = np.r_[True, bore_index[1:] != bore_index[:-1]]
+        keep = within | (nearest & (within_count[bore_index] == 0))
+        bore_index, sounding, distance, within = bore_index[keep], sounding[keep], distance[keep], within[keep]
+    inverse = np.where(within, 1 / np.maximum(distance, 1), 0)
+    total = np.bincount(bore_index, weights=inverse, minlength=len(bores))
+    weight = np.divide(inverse, total[bore_index], out=np.zeros(len(inverse)), where=total[bore_index] > 0)
+    match = pd.DataFrame({'Bore': bores[bore_index],
+                          'distance': distance,
+                          'within': within,
+                          'weight': weight,
+                          'start': starts[sounding],
+                          'stop': stops[sounding]})
+    return match, order
 
 def select_closest(ttemdata: pd.DataFrame | gpd.GeoDataFrame,
                    welllog: pd.DataFrame | gpd.GeoDataFrame,
                    search_radius=500,
                    showskip=False,
+                   k: int | None = 1,
                    ):
-    def get_distance(group1, group2):
-        dis = np.sqrt((group1[0] - group2[0]) ** 2 + (group1[1] - group2[1]) ** 2)
-        return dis
-    concatlist = []
-    concatwell = []
-    skipname = []
-    skipdistace = []
-    ori_well = welllog
-    groups_well = ori_well.groupby('Bore')
-    ttem_location = list(ttemdata.groupby(['X', 'Y']).groups.keys())
-    for name, group in groups_well:
-        wellxy = list(group[['X','Y']].iloc[0])
-        well_ttem_distance = list(map(lambda x: get_distance(wellxy, x), ttem_location))
-        minvalue = min(well_ttem_distance)
-        if minvalue <= float(search_radius):
-            point_match = ttem_location[well_ttem_distance.index(minvalue)]
-            matchpoint = ttemdata[(ttemdata['X'] == point_match[0]) & (ttemdata['Y'] == point_match[1])].copy()
-            matchpoint.loc[:, 'distance'] = minvalue
-            matchpoint.loc[:, 'Bore'] = name
-            concatlist.append(matchpoint)
-            concatwell.append(group)
-        else:
-            skipname.append(name)
-            skipdistace.append(minvalue)
-    try:
-        matched_ttem = pd.concat(concatlist).reset_index(drop=True)
-    except ValueError:
-        matched_ttem = pd.DataFrame()
-    try:
-        matched_well = pd.concat(concatwell).reset_index(drop=True)
-    except ValueError:
-        matched_well = pd.DataFrame()
-    skipped = pd.DataFrame({'Bore': skipname, 'Distance': skipdistace})
-    print('Total of {} well with in radius ({}m), {} skipped'.format(len(concatlist), search_radius, len(skipname)))
+    """
+    Pick the tTEM sounding(s) closest to each bore within search_radius.
+    :param ttemdata: tTEM dataframe
+    :param welllog: well log dataframe
+    :param search_radius: maximum distance between a bore and a sounding
+    :param showskip: also return the bores outside search_radius and their nearest distance
+    :param k: number of nearest soundings for each bore, None to use every sounding within search_radius. \
+    The matched layers carry an inverse-distance weight column (1 when k=1) that can be passed to bootstrap
+    :return: matched tTEM layers, matched well logs (and skipped bores)
+    """
+    match, order = match_soundings(ttemdata, welllog, search_radius, k)
+    matched = match[match['within'].to_numpy()]
+    skipped_match = match[~match['Bore'].isin(matched['Bore'])]
+    lengths = (matched['stop'] - matched['start']).to_numpy()
+    rows = order[_concat_ranges(matched['start'].to_numpy(), matched['stop'].to_numpy())]
+    matched_ttem = ttemdata.iloc[rows].copy()
+    matched_ttem.loc[:, 'distance'] = np.repeat(matched['distance'].to_numpy(), lengths)
+    matched_ttem.loc[:, 'Bore'] = np.repeat(matched['Bore'].to_numpy(), lengths)
+    matched_ttem.loc[:, 'weight'] = np.repeat(matched['weight'].to_numpy(), lengths)
+    matched_ttem.reset_index(drop=True, inplace=True)
+    well_rows = np.flatnonzero(welllog['Bore'].isin(matched['Bore']).to_numpy())
+    well_codes = pd.factorize(welllog['Bore'], sort=True)[0][well_rows]
+    matched_well = welllog.iloc[well_rows[np.argsort(well_codes, kind='stable')]].reset_index(drop=True)
+    skipped = pd.DataFrame({'Bore': skipped_match['Bore'].to_numpy(),
+                            'Distance': skipped_match['distance'].to_numpy()})
+    print('Total of {} well with in radius ({}m), {} skipped'.format(matched['Bore'].nunique(), search_radius,
+                                                                     len(skipped)))
     if showskip is False:
         return matched_ttem, matched_well
     else:
         return matched_ttem, matched_well, skipped
 
-def sum_thickness(welllog): # receive single bore well_log and sum up the thickness of fine/mix/coarse material
-    output = pd.DataFrame(columns=["Lithology", "Thickness"])
-    init_lith = welllog["Keyword"].iloc[0]
-    init_elev = welllog["Elevation_top"].iloc[0]
-    concatlist=[]
-    # TODO make pure ndarry to fit JIT to increase speed
-    for index, row in welllog.iterrows():
-        if row["Keyword"] == init_lith:
-            pass
-        elif row["Keyword"] != init_lith:
-            pack = [init_lith, init_elev - row["Elevation_top"]]
-            tmp = pd.DataFrame(pack,index=('Lithology','Thickness')).T
-            concatlist.append(tmp)
-            init_lith = row["Keyword"]
-            init_elev = row["Elevation_top"]
-        else:
-            print("error")
-        if row["Elevation_top"] == welllog.loc[welllog.index[-1], 'Elevation_top']:
-            pack = [init_lith, init_elev - row["Elevation_top"]]
-            tmp = pd.DataFrame(pack,index=('Lithology','Thickness')).T
-            concatlist.append(tmp)
-    output = pd.concat(concatlist)
-    output = output.groupby("Lithology")["Thickness"].sum()
-    return output
-
-def ttem_well_connect(matched_ttem, matched_well):
-    # use ttem data interval to filter out welllog data to make a bootstrap ready dataframe
-    matched_ttem[["Fine", "Mix", "Coarse"]] = 0
-    #TODO make pure numpy format to increase speed
-    concatlist= []
-    ttem_group = matched_ttem.groupby('Bore')
-    for name, group in ttem_group:
-        well_select = matched_well[matched_well['Bore'] == name].copy()
-        for index, row in group.iterrows():
-            top = row["Elevation_Cell"]
-            bott = row["Elevation_End"]
-            match_litho = well_select[(well_select['Elevation_top'] >= bott) & (well_select['Elevation_bottom'] < top)]
-            if match_litho.empty:
-                break
-            thickness = dict(match_litho.groupby('Keyword')['Keyword'].count()*match_litho['Thickness'].iloc[0])
+def _run_length(group, code):
+    """
+    Run-length encode consecutive equal (group, code) pairs.
+    :param group: int array, e.g. bore code of each interval
+    :param code: int array, e.g. class code of each interval
+    :return: start index and length of every run
+    """
+    change = np.flatnonzero((group[1:] != group[:-1]) | (code[1:] != code[:-1])) + 1
+    starts = np.concatenate([[0], change]) if len(code) > 0 else np.empty(0, dtype='int64')
+    return starts, np.diff(np.append(starts, len(code)))
 
-            if "fine grain" in thickness:
-                row["Fine"] = row["Coarse"]+thickness["fine grain"]
-            else:
-                row["Fine"] = 0
-            if "mix grain" in thickness:
-                row["Mix"] = row["Mix"]+thickness["mix grain"]
-            else:
-                row["Mix"] = 0
-            if "coarse grain" in thickness:
-                row["Coarse"] = row["Coarse"]+thickness["coarse grain"]
-            else:
-                row["Coarse"] = 0
-            row = row.to_frame().T
-            concatlist.append(row)
-    df = pd.concat(concatlist).reset_index(drop=True)
+def _class_code(welllog, classes, n_class):
+    # 0 based class code of every interval, -1 for unclassified. Keyword_n has to fit the vocabulary, a larger
+    # code would be counted as a class of the next bore/layer
+    if 'Keyword_n' not in welllog.columns:
+        return tools.encode_lithology(welllog['Keyword'], classes).cat.codes.to_numpy(dtype='int64')
+    class_code = welllog['Keyword_n'].to_numpy(dtype='int64') - 1
+    if len(class_code) and class_code.max() >= n_class:
+        raise ValueError('Keyword_n goes up to {} but there are only {} lithology classes, pass the classes the well '
+                         'log was encoded with'.format(class_code.max() + 1, n_class))
+    return class_code
+
+def sum_thickness(welllog, classes=None):
+    """
+    Sum up the thickness of every lithology class for all bores at once. Intervals are ordered from top to bottom
+    within each bore, consecutive intervals of the same class are merged into runs (np.add.reduceat of the interval
+    thickness), and the runs are added up per (bore, class).
+    :param welllog: well log dataframe from ProcessWell
+    :param classes: lithology vocabulary, anything accepted by tools.lithology_classes
+    :return: bores x classes dataframe of thickness
+    """
+    dtype = tools.lithology_dtype(classes)
+    n_class = len(dtype.categories)
+    bore_code, bores = pd.factorize(welllog['Bore'], sort=True)
+    class_code = _class_code(welllog, classes, n_class)
+    top = welllog['Elevation_top'].to_numpy(dtype='float64')
+    order = np.lexsort((-top, bore_code))
+    bore_code, class_code = bore_code[order], class_code[order]
+    starts, lengths = _run_length(bore_code, class_code)
+    if len(starts) == 0:
+        return pd.DataFrame(columns=pd.Index(dtype.categories, name='Lithology'), index=pd.Index([], name='Bore'))
+    run_class = class_code[starts]
+    run_thickness = np.add.reduceat(welllog['Thickness'].to_numpy(dtype='float64')[order], starts)
+    keep = (run_class >= 0) & (bore_code[starts] >= 0)
+    thickness = np.bincount(bore_code[starts][keep] * n_class + run_class[keep], weights=run_thickness[keep],
+                            minlength=len(bores) * n_class).reshape(len(bores), n_class)
+    return pd.DataFrame(thickness, index=pd.Index(bores, name='Bore'),
+                        columns=pd.Index(dtype.categories, name='Lithology'))
+
+def _interval_overlap(layer_group, layer_top, layer_bottom,
+                      interval_group, interval_top, interval_bottom, interval_class, n_class):
+    """
+    Thickness of each class inside every layer, for all groups (bores) at once. The thickness of a class below an
+    elevation z is sum(z - bottom) over interval bottoms under z minus sum(z - top) over interval tops under z, both
+    sums come from prefix sums of the sorted bottoms/tops located with searchsorted. The overlap of a layer is the
+    difference of that thickness at the layer top and bottom.
+    :param layer_group: int group code of each layer
+    :param layer_top, layer_bottom: layer elevations
+    :param interval_group: int group code of each interval
+    :param interval_top, interval_bottom: interval elevations
+    :param interval_class: class code of each interval, 0..n_class-1, -1 for unclassified
+    :param n_class: number of classes
+    :return: (n_layer, n_class + 1) array, the last column is the total overlapped thickness of all intervals
+    """
+    if len(interval_group) == 0 or len(layer_group) == 0:
+        return np.zeros((len(layer_group), n_class + 1))
+    elevation = np.concatenate([interval_top, interval_bottom, layer_top, layer_bottom])
+    low = elevation.min()
+    stride = elevation.max() - low + 1
+    n_group = max(interval_group.max(), layer_group.max()) + 1
+    # unclassified intervals are counted in an extra class so they add to the total
+    segment = np.where(interval_class >= 0, interval_class, n_class) * n_group + interval_group
+    layer_segment = np.arange(n_class + 1) * n_group + layer_group[:, None]
+
+    def below(edge):
+        key = segment * stride + (edge - low)
+        sort = np.argsort(key, kind='stable')
+        key = key[sort]
+        total = np.concatenate([[0], np.cumsum(edge[sort] - low)])
+        start = np.searchsorted(key, layer_segment * stride, side='left')
+
+        def edge_term(layer_edge):
+            stop = np.searchsorted(key, layer_segment * stride + (layer_edge - low)[:, None], side='right')
+            return (stop - start) * (layer_edge - low)[:, None] - (total[stop] - total[start])
+
+        return edge_term(layer_top) - edge_term(layer_bottom)
+
+    overlap = below(interval_bottom) - below(interval_top)
+    overlap[:, -1] = overlap.sum(axis=1)
+    return overlap
+
+def ttem_well_connect(matched_ttem, matched_well, classes=None):
+    """
+    Use tTEM layer intervals to sum up the thickness of each lithology class from the matched well log, and make a
+    bootstrap ready dataframe. Every (layer, bore) pair is computed at once, layers that do not overlap the well log
+    are dropped.
+    :param matched_ttem: matched tTEM layers from select_closest
+    :param matched_well: matched well logs from select_closest
+    :param classes: lithology vocabulary, anything accepted by tools.lithology_classes
+    :return: matched_ttem rows with one thickness column per class
+    """
+    columns = tools.class_columns(classes)
+    well_class = _class_code(matched_well, classes, len(columns))
+    bores = pd.Index(pd.unique(matched_ttem['Bore']))
+    well_group = bores.get_indexer(matched_well['Bore'])
+    in_ttem = well_group >= 0
+    overlap = _interval_overlap(bores.get_indexer(matched_ttem['Bore']),
+                                matched_ttem['Elevation_Cell'].to_numpy(dtype='float64'),
+                                matched_ttem['Elevation_End'].to_numpy(dtype='float64'),
+                                well_group[in_ttem],
+                                matched_well['Elevation_top'].to_numpy(dtype='float64')[in_ttem],
+                                matched_well['Elevation_bottom'].to_numpy(dtype='float64')[in_ttem],
+                                well_class[in_ttem],
+                                len(columns))
+    keep = overlap[:, -1] > 0
+    df = matched_ttem[keep].copy()
+    df[columns] = overlap[keep, :-1]
+    df.reset_index(drop=True, inplace=True)
     return df
 
-def pre_bootstrap(dataframe,welllog, distance=500):
-    matched_ttem, matched_well = select_closest(dataframe, welllog, search_radius=distance, showskip=False)
-    stitched_ttem_well = ttem_well_connect(matched_ttem, matched_well)
+def pre_bootstrap(dataframe,welllog, distance=500, classes=None, k=1):
+    """
+    Match tTEM to well logs and build the bootstrap input. With k other than 1 each bore is matched to several \
+    soundings and every row carries the inverse-distance weight of its sounding (1 when k=1).
+    :return: stitched_ttem_well, Resistivity, Thickness_ratio, matched_ttem, matched_well, Weights; pass \
+    Resistivity, Thickness_ratio, Weights to bootstrap for a weighted fit
+    """
+    matched_ttem, matched_well = select_closest(dataframe, welllog, search_radius=distance, showskip=False, k=k)
+    stitched_ttem_well = ttem_well_connect(matched_ttem, matched_well, classes)
     Resistivity = stitched_ttem_well["Resistivity"].to_numpy().astype('float64')
-    Thickness_ratio = stitched_ttem_well[["Fine", "Mix", "Coarse"]].div(stitched_ttem_well["Thickness"],
+    Thickness_ratio = stitched_ttem_well[tools.class_columns(classes)].div(stitched_ttem_well["Thickness"],
                                                                    axis=0).to_numpy().astype('float64')
-    return stitched_ttem_well, Resistivity, Thickness_ratio, matched_ttem, matched_well
+    Weights = stitched_ttem_well["weight"].to_numpy().astype('float64')
+    return stitched_ttem_well, Resistivity, Thickness_ratio, matched_ttem, matched_well, Weights
+
+
+def _solve_replicates(resistivity, thickness_ratio, weights, counts):
+    """
+    Solve the bootstrap replicates given by their resample counts (n_boot, n_rows), the number of times every row
+    is drawn. The normal equations (A^T W A) x = A^T W (1/rho) of every replicate are the counts times the per-row
+    outer products, and all replicates are solved in one batched call. A class absent from a replicate gets a
+    coefficient of 0.
+    :return: (n_boot, n_class) resistivity, 0 where the coefficient is 0
+    """
+    n_boot, n_row = counts.shape
+    n_class = thickness_ratio.shape[1]
+    outer = (weights[:, None, None] * thickness_ratio[:, :, None] * thickness_ratio[:, None, :]).reshape(n_row, -1)
+    rhs = weights[:, None] * thickness_ratio / resistivity[:, None]
+    normal = (counts @ outer).reshape(n_boot, n_class, n_class)
+    target = counts @ rhs
+    diagonal = np.arange(n_class)
+    empty = normal[:, diagonal, diagonal] == 0
+    normal[:, diagonal, diagonal] += empty # keeps the system solvable, the coefficient stays 0 as target is 0
+    try:
+        coefficient = np.linalg.solve(normal, target[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        coefficient = (np.linalg.pinv(normal) @ target[..., None])[..., 0]
+    return np.divide(1, coefficient, out=np.zeros_like(coefficient), where=coefficient != 0)
+
+def _resample_counts(rng, n_row, n_boot):
+    # number of times every row is drawn in n_boot resamples of n_row rows with replacement, i.e. multinomial
+    # (n_row, 1/n_row) counts. Counting uniform draws is several times faster than rng.multinomial, which draws one
+    # binomial per row
+    draw = rng.integers(0, n_row, size=(n_boot, n_row))
+    flat = (np.arange(n_boot)[:, None] * n_row + draw).ravel()
+    return np.bincount(flat, minlength=draw.size).reshape(draw.shape).astype('float64')
+
+def _bootstrap_chunk(resistivity, thickness_ratio, weights, n_boot, seed):
+    # one chunk of replicates drawn from its own random stream, module level so it can run in a worker process.
+    # A few replicates are drawn and solved at a time to stay in cache, no (n_boot, n_row) matrix is kept
+    rng = np.random.default_rng(seed)
+    block = max(1, 2 ** 18 // max(len(resistivity), 1))
+    return np.concatenate([_solve_replicates(resistivity, thickness_ratio, weights,
+                                             _resample_counts(rng, len(resistivity), min(block, n_boot - start)))
+                           for start in range(0, n_boot, block)])
 
+def _seed_streams(seed, n):
+    # independent child streams of an int seed / SeedSequence / Generator, one per chunk
+    if isinstance(seed, np.random.Generator):
+        return seed.spawn(n)
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed.spawn(n)
+
+def _replicate_chunks(resistivity, thickness_ratio, weights, n_boot, seed, chunk_size, workers):
+    """
+    Yield (chunk, n_class) blocks of bootstrap replicates in a fixed order. Replicates are split in chunks of
+    chunk_size and every chunk draws from its own child of the seed (SeedSequence.spawn), so the replicates only
+    depend on seed and chunk_size, never on the number of workers.
+    """
+    resistivity = np.asarray(resistivity, dtype='float64')
+    thickness_ratio = np.asarray(thickness_ratio, dtype='float64')
+    if weights is None:
+        weights = np.ones(len(resistivity))
+    weights = np.asarray(weights, dtype='float64')
+    sizes = [min(chunk_size, n_boot - start) for start in range(0, n_boot, chunk_size)]
+    streams = _seed_streams(seed, len(sizes))
+    if workers is None or workers <= 1 or len(sizes) == 1:
+        for size, stream in zip(sizes, streams):
+            yield _bootstrap_chunk(resistivity, thickness_ratio, weights, size, stream)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(_bootstrap_chunk, repeat(resistivity), repeat(thickness_ratio),
+                                    repeat(weights), sizes, streams)
 
-def bootstrap(resistivity, thickness_ratio):
+def bootstrap(resistivity, thickness_ratio, weights=None, n_boot=1000, seed=None, workers=None, chunk_size=1000):
     """
     bootstrap method, randomly pick from pre_bootstrap dataset to create a new data set with same shape,
-    use thenew data set as an over-determined problem to solve the equation. Repeat 1000 times and output the resistivity
+    use thenew data set as an over-determined problem to solve the equation. Repeat n_boot times and output the resistivity
     The linear algebra equation check https://ngwa.onlinelibrary.wiley.com/doi/full/10.1111/gwat.12656
+    weights are optional row weights (e.g. the inverse-distance weight from pre_bootstrap), each sample is solved as
+    a weighted least squares problem. The resample counts of a chunk are drawn at once and solved together.
+    :param n_boot: number of bootstrap replicates, default is 1000
+    :param seed: int seed or np.random.Generator for reproducible results
+    :param workers: number of processes sharing the chunks, default is None (run in the main process). The result \
+    does not depend on the number of workers
+    :param chunk_size: number of replicates drawn from one random stream
+    :return: one array of n_boot resistivity for each class (column of thickness_ratio)
     """
     print('Bootstraping...')
-    fine_Resistivity = np.empty(1000)
-    mix_Resistivity = np.empty(1000)
-    coarse_Resistivity = np.empty(1000)
-    for k in range(1000):
-        random_index = np.random.choice(np.arange(len(resistivity)), len(resistivity), replace=True)
-        resistivity_sample = resistivity[random_index]
-        resistivity_reverse = 1 / resistivity_sample
-        thickness_ratio_sample = thickness_ratio[random_index]
-        lstsq_result = np.linalg.lstsq(thickness_ratio_sample, resistivity_reverse)
-        if lstsq_result[0][0] == 0:
-            fine_Resistivity[k] = 0
-        else:
-            fine_Resistivity[k] = 1/lstsq_result[0][0]
-        if lstsq_result[0][1] == 0:
-            mix_Resistivity[k] = 0
-        else:
-            mix_Resistivity[k] = 1/lstsq_result[0][1]
-        if lstsq_result[0][2] == 0:
-            coarse_Resistivity[k] = 0
-        else:
-            coarse_Resistivity[k] = 1/lstsq_result[0][2]
+    class_resistivity = np.concatenate(list(_replicate_chunks(resistivity, thickness_ratio, weights,
+                                                              n_boot, seed, chunk_size, workers)))
     print('Done!')
-    return fine_Resistivity, mix_Resistivity, coarse_Resistivity
+    return tuple(class_resistivity.T)
+
+def bootstrap_confidence(resistivity, thickness_ratio, weights=None, confidence=95, n_boot=1000, seed=None,
+                         workers=None, chunk_size=1000, classes=None):
+    """
+    Same replicates as bootstrap, reduced to the confidence interval of every class while the chunks stream in.
+    Only the replicates in the two tails that the percentiles need are kept, so memory does not grow with n_boot.
+    The interval equals confidence(bootstrap(...)) with the same seed and chunk_size.
+    :param confidence: confidence level in percent
+    :param classes: lithology vocabulary used to name the columns, anything accepted by tools.lithology_classes
+    :return: dataframe in packup format, one column of [lower, upper] per class
+    """
+    print('Bootstraping...')
+    position = np.array([(100 - confidence)/2, confidence+(100 - confidence)/2]) / 100 * (n_boot - 1)
+    below = np.floor(position).astype('int64')
+    n_low = min(below[0] + 2, n_boot) # smallest values needed for the lower percentile
+    n_high = min(n_boot - below[1], n_boot) # largest values needed for the upper percentile
+    low, high = None, None
+    for chunk in _replicate_chunks(resistivity, thickness_ratio, weights, n_boot, seed, chunk_size, workers):
+        low = chunk if low is None else np.concatenate([low, chunk])
+        high = chunk if high is None else np.concatenate([high, chunk])
+        if len(low) > n_low:
+            low = np.partition(low, n_low - 1, axis=0)[:n_low]
+        if len(high) > n_high:
+            high = np.partition(high, len(high) - n_high, axis=0)[-n_high:]
+    low, high = np.sort(low, axis=0), np.sort(high, axis=0)
+    ordered = [low, high]
+    offset = [0, n_boot - n_high]
+    bounds = []
+    for i in range(2):
+        lower = ordered[i][below[i] - offset[i]]
+        upper = ordered[i][min(below[i] + 1, n_boot - 1) - offset[i]]
+        fraction = position[i] - below[i]
+        difference = upper - lower
+        bounds.append(np.where(fraction >= 0.5, upper - difference * (1 - fraction), lower + difference * fraction))
+    print('Done!')
+    columns = ['{}_conf'.format(column) for column in tools.class_columns(classes)]
+    return pd.DataFrame(np.vstack(bounds), columns=columns[:len(bounds[0])])
+
+def bootstrap_adaptive(resistivity, thickness_ratio, weights=None, confidence=95, tol=0.01, batch_size=200,
+                       max_boot=20000, patience=2, seed=None, workers=None, classes=None):
+    """
+    Run bootstrap in batches until the confidence interval stops moving: the endpoints of every class must change
+    by less than tol (relative) for patience batches in a row, or max_boot replicates are reached. Batches are
+    seeded like the chunks of bootstrap, the replicates used do not depend on the number of workers.
+    :param confidence: confidence level in percent
+    :param tol: relative change of the interval endpoints that counts as converged
+    :param batch_size: number of replicates added between two checks
+    :param max_boot: upper limit of replicates
+    :param patience: number of consecutive converged batches before stopping
+    :param workers: number of processes, each one runs a batch
+    :param classes: lithology vocabulary used to name the columns, anything accepted by tools.lithology_classes
+    :return: confidence interval dataframe in packup format, with attrs n_boot and converged, and the \
+    convergence trace (one row per batch: replicates so far, interval endpoints and largest relative change)
+    """
+    print('Bootstraping...')
+    resistivity = np.asarray(resistivity, dtype='float64')
+    thickness_ratio = np.asarray(thickness_ratio, dtype='float64')
+    weights = np.ones(len(resistivity)) if weights is None else np.asarray(weights, dtype='float64')
+    columns = tools.class_columns(classes)[:thickness_ratio.shape[1]]
+    percentile = [(100 - confidence)/2, confidence+(100 - confidence)/2]
+    sizes = [min(batch_size, max_boot - start) for start in range(0, max_boot, batch_size)]
+    streams = _seed_streams(seed, len(sizes))
+    executor = ProcessPoolExecutor(max_workers=workers) if workers is not None and workers > 1 else None
+    step = 1 if executor is None else workers
+    replicates, trace = [], []
+    interval, stable, converged = None, 0, False
+    try:
+        for first in range(0, len(sizes), step):
+            batch = slice(first, first + step)
+            if executor is None:
+                results = [_bootstrap_chunk(resistivity, thickness_ratio, weights, sizes[first], streams[first])]
+            else:
+                results = list(executor.map(_bootstrap_chunk, repeat(resistivity), repeat(thickness_ratio),
+                                            repeat(weights), sizes[batch], streams[batch]))
+            # batches are checked one by one in order, extra batches of the last round are dropped
+            for result in results:
+                replicates.append(result)
+                new_interval = np.percentile(np.concatenate(replicates), percentile, axis=0)
+                if interval is None:
+                    change = np.inf
+                else:
+                    change = np.max(np.abs(new_interval - interval) / np.maximum(np.abs(interval), 1e-12))
+                interval = new_interval
+                stable = stable + 1 if change < tol else 0
+                row = {'n_boot': sum(len(r) for r in replicates), 'max_change': change}
+                for i, column in enumerate(columns):
+                    row['{}_lower'.format(column)] = interval[0, i]
+                    row['{}_upper'.format(column)] = interval[1, i]
+                trace.append(row)
+                if stable >= patience:
+                    converged = True
+                    break
+            if converged:
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    Resi_conf_df = pd.DataFrame(interval, columns=['{}_conf'.format(column) for column in columns])
+    Resi_conf_df.attrs['n_boot'] = trace[-1]['n_boot']
+    Resi_conf_df.attrs['converged'] = converged
+    print('Done! {} replicates, {}'.format(trace[-1]['n_boot'], 'converged' if converged else 'not converged'))
+    return Resi_conf_df, pd.DataFrame(trace)
 
 def confidence(bootstrap_result, confidence=95): #95% condifence interval
     confidence_index = [(100 - confidence)/2, confidence+(100 - confidence)/2]
@@ -154,9 +488,17 @@ def confidence(bootstrap_result, confidence=95): #95% condifence interval
                            np.percentile(bootstrap_result, confidence_index[1])]
     return confidence_interval
 
-def packup(Fine_Resistivity, Mix_Resistivity, Coarse_Resistivity):
-
-    Resi_conf_df = pd.DataFrame({"Fine_conf": confidence(Fine_Resistivity),
-                                 "Mix_conf": confidence(Mix_Resistivity),
-                                 "Coarse_conf": confidence(Coarse_Resistivity)})
+def packup(*class_resistivity, classes=None):
+    """
+    Pack the bootstrap result of every class into a confidence interval dataframe, e.g.
+    packup(Fine_Resistivity, Mix_Resistivity, Coarse_Resistivity) or packup(*bootstrap(...), classes=classes).
+    :param class_resistivity: one array of bootstrap resistivity per class, in class order
+    :param classes: lithology vocabulary, anything accepted by tools.lithology_classes
+    :return: dataframe with one <class>_conf column of [lower, upper] per class
+    """
+    columns = tools.class_columns(classes)
+    if len(class_resistivity) != len(columns):
+        raise ValueError('Got {} bootstrap results for the classes {}'.format(len(class_resistivity), columns))
+    Resi_conf_df = pd.DataFrame({'{}_conf'.format(column): confidence(resistivity)
+                                 for column, resistivity in zip(columns, class_resistivity)})
     return Resi_conf_df
\ No newline at end of file
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
-import sys
 import pandas as pd
 from pyproj import Transformer
-from . import process_well
+from scipy.spatial import cKDTree
+from . import process_well, lithology_connect
 import numpy as np
 import re
 
@@ -100,44 +100,67 @@ def gamma_well_connect(gamma_df, welllog):
     return ori_well_with_gamma
 
 
-def gamma_ttem_connect(gamma_df, ttem):
-    gamma_place = list(gamma_df.groupby("comment").groups.keys())
-    utmx = gamma_df.loc[:, "X"].values[0]
-    utmy = gamma_df.loc[:, "Y"].values[0]
-    ttem.loc[:, "gamma_distance"] = np.sqrt((ttem.loc[:, "UTMX"] - utmx) ** 2 +
-                                          (ttem.loc[:, "UTMY"] - utmy) ** 2)
-    ttem_closest = ttem[ttem["gamma_distance"] == ttem.gamma_distance.min()].reset_index(drop=True)
-    ttem_with_gamma = pd.DataFrame(columns=ttem.columns)
-    ttem_with_gamma["GR"] = np.nan
-    for index, row in ttem_closest.iterrows():
-        ### small progress bar
-        print('\r', end='')
-        print("Progress {}/{}".format(index, ttem_closest.shape[0]), end='')
-        sys.stdout.flush()
-        ###
-        toplimit = row["Elevation_Cell"]
-        botlimit = row["Elevation_End"]
-        if row["gamma_distance"] > 1000:
-            print("\n {} is too far away from ttem lines".format(gamma_df["comment"][0]))
-            break
-        if botlimit > gamma_df.loc[0, "Elevation"]:
-            continue
-        if toplimit > gamma_df.loc[0, "Elevation"]:
-            toplimit = gamma_df.loc[index, "Elevation"]
-            row["Elevation_Cell"] = toplimit
-            row["Elevation_End"] = row["Elevation_Cell"] - row["Thickness"]
-
-        tmp_gamma_df = gamma_df[(gamma_df.loc[:,"Elevation"] >= botlimit) &
-                                (gamma_df.loc[:,"Elevation"] < toplimit)]
-        gamma_total = tmp_gamma_df.loc[:,"GR"].sum()
-        if gamma_total == 0:
-            break
-        gamma_total_series = pd.Series({"GR": gamma_total})
-        row = row.append(gamma_total_series)
-        ttem_with_gamma = ttem_with_gamma.append(row, ignore_index=True)
-    ttem_with_gamma["GRM"] =ttem_with_gamma["GR"].div(ttem_with_gamma["Elevation_Cell"].sub(ttem_with_gamma["Elevation_End"]))
-    ttem_with_gamma["comment"] = gamma_place[0]
-    return ttem_with_gamma
-
+def gamma_ttem_connect(gamma_df, ttem, max_distance=1000):
+    """
+    Sum the gamma log inside every layer of the closest tTEM sounding. Several logs (told apart by comment) are
+    connected in one call: the logs are sorted once by log and elevation into a cumulative GR sum, and the GR total
+    of every layer is the difference of two searchsorted positions in it.
+    :param gamma_df: georeferenced gamma log(s) with comment, X, Y, Elevation and GR
+    :param ttem: tTEM dataframe with X/Y (or UTMX/UTMY), Elevation_Cell and Elevation_End
+    :param max_distance: logs further than max_distance from every sounding are skipped
+    :return: layers of the closest sounding of each log with gamma_distance, GR (total), GR_count (samples), \
+    GRM (GR per unit of layer thickness) and GR_mean (mean of the samples) and comment. Layers are clipped to the \
+    top of the log (Elevation_Cell and Thickness), layers without any gamma sample are dropped
+    """
+    if not {'X', 'Y'}.issubset(ttem.columns):
+        ttem = ttem.rename(columns={'UTMX': 'X', 'UTMY': 'Y'})
+    log_codes, logs = pd.factorize(gamma_df['comment'], sort=True)
+    valid = (log_codes >= 0) & gamma_df['Elevation'].notna().to_numpy()
+    if not valid.any():
+        print('No gamma sample with an elevation, nothing to connect')
+        return ttem.iloc[:0].assign(gamma_distance=np.empty(0), GR=np.empty(0), GR_count=np.empty(0, dtype='int64'),
+                                    GRM=np.empty(0), GR_mean=np.empty(0),
+                                    comment=np.empty(0, dtype='object')).reset_index(drop=True)
+    first_row = np.unique(log_codes[log_codes >= 0], return_index=True)[1]
+    first_row = np.flatnonzero(log_codes >= 0)[first_row]
+    gamma_xy = gamma_df[['X', 'Y']].to_numpy(dtype='float64')[first_row]
+    sounding_xy, order, starts, stops = lithology_connect.sounding_index(ttem)
+    distance, nearest = cKDTree(sounding_xy).query(gamma_xy)
+    for log in logs[distance > max_distance]:
+        print('{} is too far away from ttem lines'.format(log))
+    connected = np.flatnonzero(distance <= max_distance)
+    # rows of the closest sounding of every connected log, one block per log
+    rows = order[lithology_connect._concat_ranges(starts[nearest[connected]], stops[nearest[connected]])]
+    layer_log = np.repeat(connected, (stops - starts)[nearest[connected]])
 
+    code = log_codes[valid]
+    elevation = gamma_df['Elevation'].to_numpy(dtype='float64')[valid]
+    gr = gamma_df['GR'].to_numpy(dtype='float64')[valid]
+    log_top = np.full(len(logs), -np.inf)
+    np.maximum.at(log_top, code, elevation)
+    top = np.minimum(ttem['Elevation_Cell'].to_numpy(dtype='float64')[rows], log_top[layer_log])
+    bottom = ttem['Elevation_End'].to_numpy(dtype='float64')[rows]
+    key, bottom_key, top_key = lithology_connect._group_keys(code, elevation, (layer_log, bottom), (layer_log, top))
+    sort = np.argsort(key, kind='stable')
+    key = key[sort]
+    cumulative_gr = np.concatenate([[0], np.cumsum(np.nan_to_num(gr[sort]))])
+    cumulative_count = np.concatenate([[0], np.cumsum(~np.isnan(gr[sort]))])
+    # samples with bottom <= Elevation < top
+    lower = np.searchsorted(key, bottom_key, side='left')
+    upper = np.searchsorted(key, top_key, side='left')
+    upper = np.maximum(upper, lower)
+    gamma_total = cumulative_gr[upper] - cumulative_gr[lower]
+    gamma_count = cumulative_count[upper] - cumulative_count[lower]
 
+    ttem_with_gamma = ttem.iloc[rows].reset_index(drop=True)
+    ttem_with_gamma['Elevation_Cell'] = top
+    if 'Thickness' in ttem_with_gamma.columns:
+        ttem_with_gamma['Thickness'] = top - bottom
+    ttem_with_gamma['gamma_distance'] = distance[layer_log]
+    ttem_with_gamma['GR'] = gamma_total
+    ttem_with_gamma['GR_count'] = gamma_count
+    ttem_with_gamma['GRM'] = gamma_total / (top - bottom)
+    ttem_with_gamma['GR_mean'] = gamma_total / np.maximum(gamma_count, 1)
+    ttem_with_gamma['comment'] = np.asarray(logs)[layer_log]
+    ttem_with_gamma = ttem_with_gamma[(bottom < top) & (gamma_count > 0)].reset_index(drop=True)
+    return ttem_with_gamma
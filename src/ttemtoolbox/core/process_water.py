@@ -1,60 +1,109 @@
 import pathlib
 from pathlib import Path
+import csv
+import datetime
+import io
+import json
 import re
+import time
 import pandas as pd 
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import numpy as np
+from pyproj import Transformer
+from ttemtoolbox.defaults import constants
 
 
-def dl_usgs_water(wellname, save_path=Path.cwd()):
-    '''
-    Downloads water data from the USGS website for a given well and saves it to a specified path.
-
-    Parameters:
-    - wellname (str): The name or ID of the well. It should be in the USGS well name format, e.g., '375006112554801'.
-    - save_path (str): The path where the downloaded data will be saved.
-
-    Returns:
-    - report (pd.DataFrame): The downloaded water data in a pandas DataFrame.
-    - metadata (pd.Series): Metadata about the well, including well name, latitude, longitude, datum, well depth, and altitude.
-
-    Raises:
-    - Exception: If the wellname is not in the correct format.
-    - Exception: If the download fails due to internet connection issues or the specified URL is not reachable.
+def _well_number(wellname) -> str:
+    wellname = str(wellname)
+    if wellname.isdigit():
+        return wellname
+    found = re.findall(r"\d+", wellname)
+    if not found:
+        raise ValueError("{} is not a usgs well name format, e.g.:'375006112554801'".format(wellname))
+    return found[0]
 
-    '''
+def make_session(workers: int = 8, retries: int = 3, backoff: float = 0.5) -> requests.Session:
+    """
+    HTTP session shared by concurrent downloads, with a connection pool per host sized for the workers and retries
+    with exponential backoff on connection errors and 429/5xx responses.
+    :param workers: number of concurrent connections kept per host
+    :param retries: number of retries of a failed request
+    :param backoff: backoff factor in seconds, the n-th retry waits backoff * 2 ** (n - 1)
+    :return: requests.Session
+    """
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=('GET',))
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-    if wellname.isdigit():
-        well_no = wellname
-    else:
-        try:
-            well_no = re.findall(r"\d+",wellname)[0]
-        except:
-            raise("{} is not a usgs well name format, e.g.:'375006112554801'".format(wellname))
-    url_1 = r'https://nwis.waterdata.usgs.gov/nwis/gwlevels?site_no=' + \
-             well_no + r'&agency_cd=USGS&format=rdb'
+def _get(url: str, params: dict, session: requests.Session = None, timeout: float = 30) -> requests.Response:
     try:
-        report = requests.get(url_1, stream=True)
-    except:
-        raise("Download failed! Check the Internet connection or {} is not reachable anymore".format(url_1))
+        response = (session or requests).get(url, params=params, timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException as error:
+        raise ConnectionError("Download failed! Check the Internet connection or {} is not reachable anymore ({})"
+                              .format(url, error))
+    return response
+
+def fetch_gwlevels(well_no: str | list, url: str = None, session: requests.Session = None, timeout: float = 30) -> str:
+    """
+    Download the groundwater level RDB of a USGS well, or of several wells in one request.
+    :param well_no: USGS site number, e.g. '375006112554801', or a list of them
+    :param url: base url of the gwlevels service, default constants.USGS_GWLEVELS_URL
+    :param session: shared session from make_session, default None makes a plain request
+    :param timeout: connect and read timeout in seconds
+    :return: the RDB text
+    """
+    url = url or constants.USGS_GWLEVELS_URL
+    if not isinstance(well_no, str):
+        well_no = ','.join(well_no)
+    report = _get(url, {'site_no': well_no, 'agency_cd': 'USGS', 'format': 'rdb'}, session, timeout)
     fail_pattern1 = r'Incorrectly formatted USGS site number'
     fail_pattern2 = r'No sites/data found using the selection criteria specified'
-    with open(Path(save_path, well_no), 'wb') as f:
-        for ch in report:
-            if re.search(fail_pattern1, ch.decode('utf-8')) or re.search(fail_pattern2, ch.decode('utf-8')):
-                raise Exception('Not able to find input USGS well number "{}"!'.format(well_no))
-            f.write(ch)
+    if re.search(fail_pattern1, report.text) or re.search(fail_pattern2, report.text):
+        raise Exception('Not able to find input USGS well number "{}"!'.format(well_no))
+    return report.text
+
+def _to_wgs84(lon, lat, datum):
+    # longitude/latitude in the NWIS horizontal datum to EPSG:4326, which water_table expects
+    lon = np.asarray(lon, dtype='float64').copy()
+    lat = np.asarray(lat, dtype='float64').copy()
+    datum = pd.Series(datum, dtype='object').astype(str).str.strip().str.upper().to_numpy()
+    for code in np.unique(datum):
+        rows = datum == code
+        crs = constants.USGS_DATUM_CRS.get(code)
+        if crs is None:
+            print('Unknown horizontal datum {}, its well locations are taken as EPSG:4326'.format(code))
+        elif crs != 'EPSG:4326':
+            lon[rows], lat[rows] = Transformer.from_crs(crs, 'EPSG:4326', always_xy=True).transform(lon[rows],
+                                                                                                    lat[rows])
+    return lon, lat
 
-    url_2 = r'https://waterdata.usgs.gov/nwis/inventory?agency_code=USGS&site_no=' + well_no
+def fetch_metadata(well_no: str, url: str = None, session: requests.Session = None, timeout: float = 30) -> pd.Series:
+    """
+    Download the site inventory of a USGS well and parse its metadata.
+    :param well_no: USGS site number
+    :param url: base url of the inventory page, default constants.USGS_INVENTORY_URL
+    :param session: shared session from make_session, default None makes a plain request
+    :param timeout: connect and read timeout in seconds
+    :return: well name (site number), longitude and latitude in EPSG:4326, datum of the surveyed coordinates, \
+    well depth and altitude (feet)
+    """
+    url = url or constants.USGS_INVENTORY_URL
     pattern = re.compile(
         r'<title>USGS (.*\d)  .*?</title>.*?Latitude  (.*?), &nbsp; Longitude (.*?) &nbsp; (.*?)<br />.*?Well depth: (.*?) .*?Land surface altitude:  (.*?)'
     'feet above')
     pattern_coor = r'[&#;\\\'" ]'
-    try:
-        source = requests.get(url_2)
-    except:
-        raise("Download failed! Check the Internet connection or {} is not reachable anymore".format(url_1))
+    source = _get(url, {'agency_code': 'USGS', 'site_no': well_no}, session, timeout)
     match = re.findall(pattern, str(source.content))
+    if not match:
+        raise Exception('Not able to find the inventory of USGS well number "{}"!'.format(well_no))
     sitename = match[0][0]
     prelat = re.split(pattern_coor, match[0][1])
     lat = float(prelat[0]) + float(prelat[3]) / 60 + float(prelat[5]) / (60 * 60)
@@ -69,67 +118,274 @@ def dl_usgs_water(wellname, save_path=Path.cwd()):
         altitude = float(re.split(pattern_coor, match[0][5])[0].replace(',',''))
     except:
         altitude = np.nan
-    metadata = pd.Series({'wellname': sitename, 'lon': long, 'lat': lat,  'datum': datum,
-                          'well_depth':well_depth, 'altitude':altitude})
-    report = pd.read_fwf(Path(save_path, well_no))
-    return report, metadata
+    (long,), (lat,) = _to_wgs84([long], [lat], [datum])
+    return pd.Series({'wellname': sitename, 'lon': float(long), 'lat': float(lat),  'datum': datum,
+                      'well_depth':well_depth, 'altitude':altitude, 'crs': 'EPSG:4326'})
+
+def fetch_site_metadata(well_list: list, url: str = None, session: requests.Session = None,
+                        timeout: float = 30) -> pd.DataFrame:
+    """
+    Metadata of several USGS wells from one request to the NWIS site service.
+    :param well_list: USGS site numbers
+    :param url: base url of the site service, default constants.USGS_SITE_URL
+    :param session: shared session from make_session, default None makes a plain request
+    :param timeout: connect and read timeout in seconds
+    :return: one row per found site indexed by site number, with the fields of fetch_metadata
+    """
+    url = url or constants.USGS_SITE_URL
+    source = _get(url, {'format': 'rdb', 'sites': ','.join(well_list), 'siteOutput': 'expanded'}, session, timeout)
+    sites = read_rdb(source.text)
+    lon, lat = _to_wgs84(pd.to_numeric(sites['dec_long_va'], errors='coerce'),
+                         pd.to_numeric(sites['dec_lat_va'], errors='coerce'), sites['dec_coord_datum_cd'])
+    metadata = pd.DataFrame({'wellname': sites['site_no'].to_numpy(),
+                             'lon': lon,
+                             'lat': lat,
+                             'datum': sites['dec_coord_datum_cd'].to_numpy(),
+                             'well_depth': pd.to_numeric(sites['well_depth_va'], errors='coerce').to_numpy(),
+                             'altitude': pd.to_numeric(sites['alt_va'], errors='coerce').to_numpy(),
+                             'crs': 'EPSG:4326'}, index=sites['site_no'].to_numpy())
+    return metadata
+
+def split_rdb(payload: str) -> dict:
+    """
+    Split a multi-site RDB text into one RDB text per site, each with the comments, header and format lines.
+    :return: {site number: RDB text}
+    """
+    lines = payload.splitlines()
+    row_start = 0
+    while row_start < len(lines) and lines[row_start].startswith('#'):
+        row_start += 1
+    head = lines[:row_start + 2]
+    site_column = lines[row_start].split('\t').index('site_no')
+    rows = {}
+    for line in lines[row_start + 2:]:
+        if line:
+            rows.setdefault(line.split('\t', site_column + 1)[site_column], []).append(line)
+    return {site: '\n'.join(head + site_rows) + '\n' for site, site_rows in rows.items()}
+
+def batch_usgs_water(well_list: list, cache_path: str | pathlib.PurePath = Path.cwd(), session: requests.Session = None,
+                     timeout: float = 30) -> list:
+    """
+    Download the water levels and the metadata of several wells with one request each, split them per site and
+    store them in the cache.
+    :param well_list: USGS site numbers
+    :param cache_path: cache directory
+    :param session: shared session from make_session
+    :param timeout: connect and read timeout in seconds
+    :return: the site numbers that were found and cached
+    """
+    payloads = split_rdb(fetch_gwlevels(well_list, session=session, timeout=timeout))
+    metadata = fetch_site_metadata(well_list, session=session, timeout=timeout)
+    cached = []
+    for well_no in well_list:
+        if well_no in payloads and well_no in metadata.index:
+            save_cache(well_no, cache_path, payloads[well_no], metadata.loc[well_no])
+            cached.append(well_no)
+    return cached
+
+def _cache_paths(well_no: str, cache_path) -> tuple:
+    # the payload keeps the plain site number as file name so existing downloads are reused
+    return Path(cache_path, well_no), Path(cache_path, well_no + '.json')
+
+def load_cache(well_no: str, cache_path: str | pathlib.PurePath, max_age: float = None):
+    """
+    Read a cached download of a USGS well.
+    :param well_no: USGS site number
+    :param cache_path: cache directory
+    :param max_age: maximum age of the cache in days, default None never expires
+    :return: (RDB text, metadata series), or None when the cache is missing, incomplete or expired. Caches \
+    written before the locations were converted to EPSG:4326 count as expired
+    """
+    payload_path, meta_path = _cache_paths(well_no, cache_path)
+    if not payload_path.exists() or not meta_path.exists():
+        return None
+    with open(meta_path, 'r') as file:
+        record = json.load(file)
+    if max_age is not None and time.time() - record['fetched'] > max_age * 86400:
+        return None
+    if 'crs' not in record['metadata']:
+        return None
+    return payload_path.read_text(), pd.Series(record['metadata'])
+
+def save_cache(well_no: str, cache_path: str | pathlib.PurePath, payload: str, metadata: pd.Series):
+    """
+    Store the RDB text and the metadata of a USGS well with the download time.
+    """
+    payload_path, meta_path = _cache_paths(well_no, cache_path)
+    Path(cache_path).mkdir(parents=True, exist_ok=True)
+    payload_path.write_text(payload)
+    fetched = time.time()
+    record = {'site_no': well_no,
+              'fetched': fetched,
+              'fetched_utc': datetime.datetime.fromtimestamp(fetched, datetime.timezone.utc).isoformat(),
+              'metadata': metadata.to_dict()}
+    with open(meta_path, 'w') as file:
+        json.dump(record, file, indent=1)
+
+def cached_usgs_water(wellname, cache_path: str | pathlib.PurePath = Path.cwd(), max_age: float = None,
+                      refresh: bool = False, session: requests.Session = None, timeout: float = 30) -> tuple:
+    """
+    RDB text and metadata of a USGS well, read from the cache under cache_path when it is there and younger than
+    max_age, downloaded and cached otherwise.
+    :param wellname: USGS well name or number
+    :param cache_path: cache directory
+    :param max_age: maximum age of the cache in days, default None never expires
+    :param refresh: ignore the cache and download again
+    :param session: shared session from make_session
+    :param timeout: connect and read timeout in seconds
+    :return: (RDB text, metadata series)
+    """
+    well_no = _well_number(wellname)
+    cached = None if refresh else load_cache(well_no, cache_path, max_age)
+    if cached is not None:
+        return cached
+    payload = fetch_gwlevels(well_no, session=session, timeout=timeout)
+    metadata = fetch_metadata(well_no, session=session, timeout=timeout)
+    save_cache(well_no, cache_path, payload, metadata)
+    return payload, metadata
+
+def dl_usgs_water(wellname, save_path=Path.cwd()):
+    '''
+    Downloads water data from the USGS website for a given well and saves it to a specified path.
+
+    Parameters:
+    - wellname (str): The name or ID of the well. It should be in the USGS well name format, e.g., '375006112554801'.
+    - save_path (str): The path where the downloaded data will be saved.
+
+    Returns:
+    - report (pd.DataFrame): The downloaded water data in a pandas DataFrame, see read_rdb.
+    - metadata (pd.Series): Metadata about the well, including well name, latitude, longitude, datum, well depth, and altitude.
+
+    Raises:
+    - Exception: If the wellname is not in the correct format.
+    - Exception: If the download fails due to internet connection issues or the specified URL is not reachable.
 
-def format_usgs_water(usgs_well_NO : str, dlpath: str | pathlib.PurePath =Path.cwd() ) -> pd.DataFrame:
+    '''
+    payload, metadata = cached_usgs_water(wellname, save_path, refresh=True)
+    return read_rdb(payload), metadata
+
+def read_rdb(source: str | pathlib.PurePath) -> pd.DataFrame:
+    '''
+    Parse a USGS RDB table: '#' comment lines, a tab separated header line, a format line (e.g. 5s, 10d, 12n) and
+    the tab separated data, read in one pass. Numeric (n) columns become float, date (d) columns named *_dt become
+    datetime (partial dates like 1970-03 fall on the first day, unparsable ones are NaT), other columns stay str
+    with '' for missing values.
+    :param source: RDB text or path to an RDB file
+    :return: DataFrame with the typed columns, attrs['comments'] holds the comment lines
+    '''
+    if isinstance(source, pathlib.PurePath) or (isinstance(source, str) and '\n' not in source
+                                                 and Path(source).exists()):
+        source = Path(source).read_text()
+    lines = source.splitlines()
+    row_start = 0
+    while row_start < len(lines) and lines[row_start].startswith('#'):
+        row_start += 1
+    if row_start + 1 >= len(lines):
+        raise ValueError('No RDB header found')
+    columns = lines[row_start].split('\t')
+    formats = lines[row_start + 1].split('\t')
+    data = pd.read_csv(io.StringIO(source), sep='\t', header=None, names=columns, skiprows=row_start + 2,
+                       dtype=str, keep_default_na=False, na_filter=False, quoting=csv.QUOTE_NONE)
+    for column, fmt in zip(columns, formats):
+        if fmt.endswith('n'):
+            data[column] = pd.to_numeric(data[column], errors='coerce')
+        elif fmt.endswith('d') and column.endswith('_dt'):
+            data[column] = pd.to_datetime(data[column], format='ISO8601', errors='coerce')
+    data.attrs['comments'] = lines[:row_start]
+    return data
+
+def _format_levels(report: pd.DataFrame) -> pd.DataFrame:
+    '''
+    One row per site and date from a gwlevels RDB table: the first depth to water and the first water level of each
+    datum (NGVD29, NAVD88) in meters, pivoted in one groupby.
+    '''
+    data = pd.DataFrame({'agent': report['agency_cd'].astype(str),
+                         'well_no': report['site_no'].astype(str),
+                         'time': pd.to_datetime(report['lev_dt'], format='ISO8601', errors='coerce'),
+                         'wt_blw_gd': pd.to_numeric(report['lev_va'], errors='coerce') / 3.28084,
+                         'sl_lev_va': pd.to_numeric(report['sl_lev_va'], errors='coerce') / 3.28084,
+                         'datum': report['sl_datum_cd'].astype(str)})
+    data = data[data['time'].notna()]
+    keys = ['well_no', 'time']
+    formatdata = data.groupby(keys, sort=True).agg(agent=('agent', 'first'), wt_blw_gd=('wt_blw_gd', 'first'))
+    datum = data[data['datum'].isin(['NGVD29', 'NAVD88']) & data['sl_lev_va'].notna()]
+    level = datum.groupby(keys + ['datum'], sort=True)['sl_lev_va'].first().unstack('datum')
+    level = level.reindex(columns=['NGVD29', 'NAVD88']).rename(columns={'NGVD29': 'wt_abv_ngvd29',
+                                                                        'NAVD88': 'wt_abv_navd88'})
+    formatdata = formatdata.join(level).reset_index()
+    formatdata['time'] = formatdata['time'].astype('datetime64[ns]')
+    formatdata = formatdata[['agent', 'well_no', 'time', 'wt_blw_gd', 'wt_abv_ngvd29', 'wt_abv_navd88']]
+    formatdata.columns.name = None
+    return formatdata
+
+def format_usgs_water(usgs_well_NO : str, dlpath: str | pathlib.PurePath =Path.cwd(),
+                      max_age: float = None, session: requests.Session = None, timeout: float = 30) -> pd.DataFrame:
     '''
     Formats the downloaded water data from the USGS website for a given well.
     File will contain attributes of the well and the water level data.
     Check attributes use formatdata.attrs
+    Downloads are cached under dlpath and reused until they are older than max_age days (default never), so repeat
+    runs make no network calls.
     '''
-    report = pd.DataFrame()
+    meta = None
     if isinstance(usgs_well_NO, str):
-        try:
-            exist_file = Path(dlpath, usgs_well_NO)
-            report = pd.read_fwf(exist_file)
-            _, meta = dl_usgs_water(usgs_well_NO, dlpath)
-        except:
-            report, meta = dl_usgs_water(usgs_well_NO, dlpath)
+        payload, meta = cached_usgs_water(usgs_well_NO, dlpath, max_age, session=session, timeout=timeout)
+        report = read_rdb(payload)
     elif isinstance(usgs_well_NO, pd.DataFrame):
         report = usgs_well_NO
-    #because all reports are different in column so we need to find the exact column the header start
-    row_start = report[report.apply(lambda row: row.astype(str).str.contains('agency_cd\tsite_no').any(), axis=1)].index.values[0]
-    #https://datascientyst.com/search-for-string-whole-dataframe-pandas/
-    messyinfo = report.iloc[:row_start, :]#other inforotion above header
-    data = report.iloc[row_start:, :].copy()#real data
-    data.rename(columns=data.iloc[0], inplace=True) #set data header
-    data = data.iloc[2:, :]# reset data region
-    columns = data.columns[0].split('\t') + data.columns[1:].to_list() #split columns they looks like aaa\tbbb\tccc
-    split_data = list(data.iloc[:, 0].str.split('\t').values)#data also the same format
-    formatdata = pd.DataFrame(split_data, columns=columns)#recombine the data into dataframe
-    formatdata['lev_dt'] = pd.to_datetime(formatdata['lev_dt'])
-    water_group = formatdata.groupby(['lev_dt'])
-    concat_list = []
-    column_data_types = {
-        'agent':str,
-        'well_no':str,
-        'time':'datetime64[ns]',
-        'wt_blw_gd':float,
-        'wt_abv_ngvd29':float,
-        'wt_abv_navd88':float,            
-    }
-    for time, group in water_group: 
-        temp_df = pd.DataFrame(columns=column_data_types.keys(),index=[1]).astype(column_data_types)
-        temp_df['agent'] = group['agency_cd'].iloc[0]
-        temp_df['well_no'] = group['site_no'].iloc[0]
-        temp_df['time'] = time
-        temp_df['wt_blw_gd'] = group[group['lev_va'] != '']['lev_va'].astype(float).iloc[0] / 3.28084
-        temp_df['wt_abv_ngvd29'] = group[(group['sl_lev_va'] != '') & 
-                                            (group['sl_datum_cd'] == 'NGVD29')]['sl_lev_va'].astype(float).iloc[0] /3.28084
-        temp_df['wt_abv_navd88'] = group[(group['sl_lev_va'] != '') &
-                                            (group['sl_datum_cd'] == 'NAVD88')]['sl_lev_va'].astype(float).iloc[0] /3.28084
-        concat_list.append(temp_df)
-    formatdata = pd.concat(concat_list)
+    else:
+        raise TypeError('usgs_well_NO has to be a well number or a read_rdb DataFrame not {}'.format(type(usgs_well_NO)))
+    formatdata = _format_levels(report)
     formatdata.reset_index(inplace=True, drop=True)
+    if meta is None:
+        return formatdata
+    formatdata.attrs['well_no'] = str(formatdata['well_no'].iloc[0]) if len(formatdata) else ''
     formatdata.attrs['wellname'] = meta['wellname']
     formatdata.attrs['lon'] = meta['lon']
     formatdata.attrs['lat'] = meta['lat']
     formatdata.attrs['datum'] = meta['datum']
+    formatdata.attrs['crs'] = meta['crs']
     formatdata.attrs['well_depth'] = float(meta['well_depth']) /3.28084
     formatdata.attrs['altitude'] = float(meta['altitude']) /3.28084
     formatdata.attrs['unit'] = 'meter'
     print('{} downloaded to {}'.format(formatdata.attrs['wellname'], dlpath))
     return formatdata
+
+def download_usgs_water(well_list: list, dlpath: str | pathlib.PurePath = Path.cwd(), max_age: float = None,
+                        workers: int = 8, retries: int = 3, timeout: float = 30, batch_size: int = None) -> list:
+    '''
+    Download and format many USGS wells concurrently. The wells share one pooled session with retries and backoff,
+    at most workers downloads run at a time and cached wells make no network calls. A well that still fails after
+    the retries is reported and skipped.
+    :param well_list: USGS well numbers
+    :param dlpath: download and cache directory
+    :param max_age: maximum age of the cache in days, default None never expires
+    :param workers: number of concurrent downloads
+    :param retries: number of retries of a failed request
+    :param timeout: connect and read timeout in seconds
+    :param batch_size: request the wells that are not cached in groups of batch_size sites per request (water
+    levels and site metadata), default None requests every well on its own
+    :return: list of format_usgs_water results in the order of well_list
+    '''
+    session = make_session(workers, retries)
+    def task(well):
+        try:
+            return format_usgs_water(well, dlpath, max_age=max_age, session=session, timeout=timeout)
+        except Exception as error:
+            print('Skip {}: {}'.format(well, error))
+            return None
+    def batch_task(batch):
+        try:
+            cached = batch_usgs_water(batch, dlpath, session=session, timeout=timeout)
+        except Exception as error:
+            print('Batch of {} wells failed, they are requested one by one: {}'.format(len(batch), error))
+            return
+        if len(cached) < len(batch):
+            print('Not found in batch request: {}'.format(sorted(set(batch) - set(cached))))
+    with session, ThreadPoolExecutor(max_workers=workers) as executor:
+        if batch_size:
+            well_no = list(dict.fromkeys(_well_number(well) for well in well_list))
+            missing = [well for well in well_no if load_cache(well, dlpath, max_age) is None]
+            list(executor.map(batch_task, [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]))
+        results = list(executor.map(task, well_list))
+    return [result for result in results if result is not None]
@@ -6,8 +6,8 @@
 import os
 import pathlib
 import re
+import time
 import requests
-import numpy as np
 import pandas as pd
 import geopandas as gpd
 from pyproj import Transformer
@@ -17,6 +17,7 @@ from ttemtoolbox.defaults import constants
 from ttemtoolbox import utils
 from ttemtoolbox.utils import tools
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 class ProcessWell:
     """
     This class is use to process and format lithology well logs (from excel or csv) and water level data (from USGS).\
@@ -25,11 +26,18 @@ class ProcessWell:
             shall be either csv or excel file(s) that contains lithology and location data. sheet name and column name \
             needs to be clearly marked as Lithology, Location, Latitude, Longitude, Depth_top, Depth_bottom or anything\
             similiar, keyword(s) can be modified under tTEM_toolbox/defaults/constants.py.\
+    :param lithology_classes: lithology vocabulary used to encode the keywords, a list of class names ordered from \
+            the least to the most resistive class, a dict of {keyword: class} or a path to a csv/excel mapping file. \
+            Default is constants.LITHOLOGY_CLASSES.
+    :param workers: number of processes used to parse the input files, default is None (read in the main process).\
+            Per-file timing and errors are kept in the load_report attribute, a file that fails to parse is skipped.
     """
     def __init__(self,
                  fname: str| pathlib.PurePath | list,
                  crs: str = 'epsg:4326',
-                 unit: str = 'feet'):
+                 unit: str = 'feet',
+                 lithology_classes: list | dict | str | pathlib.PurePath = None,
+                 workers: int = None):
         if isinstance(fname, str | pathlib.PurePath):
             self.fname = [fname]
             print('reading lithology from {}'.format(Path(fname).name))
@@ -46,6 +54,8 @@ class ProcessWell:
             self.unit = 'meter'
             self.unitconvert = 1
         self._crs = crs
+        self.lithology_classes = tools.lithology_classes(lithology_classes)
+        self.workers = workers
         self.data = self._format_well()
         self.crs = self.data.crs
         
@@ -75,12 +85,33 @@ class ProcessWell:
             return file_list
 
     @staticmethod
-    def _format_input(fname:str| pathlib.PurePath| list| pd.DataFrame) -> list:
+    def _read_table(path: str| pathlib.PurePath) -> tuple:
         """
-        This will format input file path(s) to a list of pandas dataframe (read from csv) and/or dict that includes all sheets in the excel\
-         file, each sheet were pandas dataframe. If input is a pandas dataframe, it will return the input dataframe in a list.
-        :param fname: one or a list of string, pathlib.PurePath object, pandas dataframe
-        :return: a list of pandas dataframe and/or dict
+        Read a single csv file, or all sheets of an excel file. Errors are returned instead of raised so one bad \
+        file does not abort a directory load.
+        :param path: path-like pathlib.PurePath object or string
+        :return: tuple of (pandas dataframe or dict of dataframes, None if failed; elapsed seconds; error message)
+        """
+        start = time.perf_counter()
+        try:
+            if Path(path).suffix in constants.EXCEL_EXTENSION:
+                table = pd.read_excel(path, sheet_name=None)
+            else:
+                table = pd.read_csv(path)
+            error = None
+        except Exception as e:
+            table = None
+            error = '{}: {}'.format(type(e).__name__, e)
+        return table, time.perf_counter() - start, error
+
+    @staticmethod
+    def _load_files(fname: str| pathlib.PurePath| list, workers: int = None) -> tuple:
+        """
+        Parse every readable file under the input path(s), in a process pool when workers > 1. Results keep the \
+        input order (per path: excel files then csv files, sorted by name) regardless of the number of workers.
+        :param fname: one or a list of string, pathlib.PurePath object
+        :param workers: number of processes, default is None (read in the main process)
+        :return: a list of pandas dataframe and/or dict, and a dataframe reports seconds and error of each file
         """
         if isinstance(fname, (str, pathlib.PurePath)):
             fname = [fname]
@@ -88,25 +119,49 @@ class ProcessWell:
             pass
         else:
             raise TypeError('Input must be one or a list of string, pathlib.PurePath objects')
-        export_list = []
+        file_list = []
         for path in fname:
-            file_list = ProcessWell._find_all_readable(path)
-            excels = [file for file in file_list if Path(file).suffix in constants.EXCEL_EXTENSION]
-            csvs = [file for file in file_list if Path(file).suffix in constants.CSV_EXTENSION]
-            read_excels = [pd.read_excel(file, sheet_name=None) for file in excels]
-            read_csvs = [pd.read_csv(file) for file in csvs]
-            combined = read_excels + read_csvs
-            export_list.append(combined)
-        result = [item for sublist in export_list for item in sublist]
+            readable = sorted(ProcessWell._find_all_readable(path), key=lambda file: Path(file).name)
+            file_list.extend([file for file in readable if Path(file).suffix in constants.EXCEL_EXTENSION])
+            file_list.extend([file for file in readable if Path(file).suffix in constants.CSV_EXTENSION])
+        if workers is not None and workers > 1 and len(file_list) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(ProcessWell._read_table, file_list))
+        else:
+            results = [ProcessWell._read_table(file) for file in file_list]
+        for file, (_, seconds, error) in zip(file_list, results):
+            if error is None:
+                print('{} read in {:.2f}s'.format(Path(file).name, seconds))
+            else:
+                print('{} skipped, {}'.format(Path(file).name, error))
+        report = pd.DataFrame({'file': [str(file) for file in file_list],
+                               'seconds': [seconds for _, seconds, _ in results],
+                               'error': [error for _, _, error in results]})
+        tables = [table for table, _, error in results if error is None]
+        if len(tables) == 0:
+            raise ValueError('None of the {} input file(s) can be read'.format(len(file_list)))
+        return tables, report
+
+    @staticmethod
+    def _format_input(fname:str| pathlib.PurePath| list| pd.DataFrame, workers: int = None) -> list:
+        """
+        This will format input file path(s) to a list of pandas dataframe (read from csv) and/or dict that includes all sheets in the excel\
+         file, each sheet were pandas dataframe. If input is a pandas dataframe, it will return the input dataframe in a list.
+        :param fname: one or a list of string, pathlib.PurePath object, pandas dataframe
+        :param workers: number of processes used to parse the files, default is None
+        :return: a list of pandas dataframe and/or dict
+        """
+        result, _ = ProcessWell._load_files(fname, workers)
         return result
     @staticmethod
-    def _read_lithology(fname: str| pathlib.PurePath |list| pd.DataFrame, mtoft=1) -> pd.DataFrame:
+    def _read_lithology(fname: str| pathlib.PurePath |list| pd.DataFrame, mtoft=1, tables: list = None) -> pd.DataFrame:
         """
         Try to read lithology sheet from Excel file with tab name similar to 'Lithology', or csv file contains lithology data.
         :param fname: one or a list of string, pathlib.PurePath object, pandas dataframe
+        :param tables: files already parsed by _format_input, fname is not read again if provided
         :return:
         """
-        result = ProcessWell._format_input(fname)
+        result = ProcessWell._format_input(fname) if tables is None else tables
         lithology_list = []
         for single_file in result:
             if isinstance(single_file, dict):  # which means it is an Excel file
@@ -142,14 +197,15 @@ class ProcessWell:
         return result
 
     @staticmethod
-    def _read_spatial(fname: str| pathlib.PurePath, mtoft=1) -> pd.DataFrame:
+    def _read_spatial(fname: str| pathlib.PurePath, mtoft=1, tables: list = None) -> pd.DataFrame:
         """
         Similiar to _read_lithology, but read location sheet from Excel file with tab name similar to 'Location', \
         or csv file contains location data.
         :param fname: fname: one or a list of string, pathlib.PurePath object, pandas dataframe
+        :param tables: files already parsed by _format_input, fname is not read again if provided
         :return:
         """
-        result = ProcessWell._format_input(fname)
+        result = ProcessWell._format_input(fname) if tables is None else tables
         location_list = []
         for single_file in result:
             if isinstance(single_file, dict):
@@ -216,22 +272,32 @@ class ProcessWell:
 
 
     @staticmethod
-    def _assign_keyword_as_value(welllog_df) -> pd.DataFrame:
-        conditionlist = [
-            (welllog_df["Keyword"] == "fine grain"),
-            (welllog_df["Keyword"] == "mix grain"),
-            (welllog_df["Keyword"] == "coarse grain")
-        ]
-        choicelist = [1, 2, 3]
-        welllog_df["Keyword_n"] = np.select(conditionlist, choicelist)
+    def _assign_keyword_as_value(welllog_df, classes=None) -> pd.DataFrame:
+        """
+        Encode Keyword as an ordered categorical of the lithology classes and store the class number in Keyword_n, \
+        the first class is 1 and keywords outside the vocabulary are 0. The original keywords are kept in \
+        Keyword_raw and the ones outside the vocabulary are printed, so the mapping can be completed.
+        """
+        if welllog_df["Keyword"].dtype != 'category':
+            welllog_df["Keyword_raw"] = welllog_df["Keyword"]
+        welllog_df["Keyword"] = tools.encode_lithology(welllog_df["Keyword"], classes)
+        if "Keyword_raw" in welllog_df.columns:
+            raw = welllog_df["Keyword_raw"]
+            unmatched = raw[welllog_df["Keyword"].isna() & raw.notna() & (raw.astype(str).str.strip() != '')]
+            if not unmatched.empty:
+                counts = unmatched.astype(str).value_counts()
+                print('{} well log rows have keywords outside the lithology classes (Keyword_n 0): {}'.format(
+                    len(unmatched), {keyword: int(count) for keyword, count in counts.items()}))
+        welllog_df["Keyword_n"] = welllog_df["Keyword"].cat.codes.to_numpy(dtype='int64') + 1
         return welllog_df
 
 
     def _format_well(self) -> gpd.GeoDataFrame:
-        lithology = self._read_lithology(self.fname, self.unitconvert)
-        location = self._read_spatial(self.fname, self.unitconvert)
+        tables, self.load_report = self._load_files(self.fname, self.workers)
+        lithology = self._read_lithology(self.fname, self.unitconvert, tables)
+        location = self._read_spatial(self.fname, self.unitconvert, tables)
         self.data = self._lithology_location_connect(lithology, location)
-        self.data = ProcessWell._assign_keyword_as_value(self.data)
+        self.data = ProcessWell._assign_keyword_as_value(self.data, self.lithology_classes)
         self.data.reset_index(drop=True, inplace=True)
         gdf = gpd.GeoDataFrame(self.data, geometry=gpd.points_from_xy(self.data['X'], self.data['Y']), 
                                crs=self._crs)
@@ -265,8 +331,8 @@ class ProcessWell:
         Returns:
         - geopandas.GeoDataFrame: The upscaled data.
         """
-        group = self.data.groupby('Bore')
-        self.data = group.apply(lambda x:ProcessWell._fill(x, scale))
+        # groupby.apply drops the Bore column on recent pandas, so the groups are filled and concatenated directly
+        self.data = pd.concat([ProcessWell._fill(group, scale) for _, group in self.data.groupby('Bore')])
         self.data.reset_index(drop=True, inplace=True)
         print('resampling lithology to {} '.format(1/scale))
         return self.data
@@ -276,7 +342,7 @@ class ProcessWell:
         concat_list = []
         for bore, group in groups: 
             total_thickness = group['Thickness'].sum()
-            keywordgroup = group.groupby('Keyword')
+            keywordgroup = group.groupby('Keyword', observed=True)
             keyword_summary = keywordgroup.agg({
                 'Thickness': 'sum',
                 'X': 'first',
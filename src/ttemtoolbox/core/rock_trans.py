@@ -1,42 +1,247 @@
 #!/usr/bin/env python
 import numpy as np
 import pandas as pd
+import geopandas as gpd
+import pyproj
 import sys
+from ttemtoolbox.utils import tools
 
-def rock_transform(ttem_data, Resi_conf_df):
+def classify(resistivity, thresholds):
+    """
+    Class codes of resistivity against a threshold vector with one searchsorted call. A value equal to the first
+    threshold belongs to the lower class, a value equal to any other threshold to the upper class, as in the
+    original fine/mix/coarse rules. Thresholds are made non-decreasing, so a class whose bounds cross is empty.
+    :param resistivity: array of resistivity
+    :param thresholds: class boundaries, len(thresholds) + 1 classes
+    :return: int64 codes from 0, -1 for nan resistivity
+    """
+    resistivity = np.asarray(resistivity, dtype='float64')
+    thresholds = np.maximum.accumulate(np.asarray(thresholds, dtype='float64'))
+    codes = np.searchsorted(thresholds, resistivity, side='right').astype('int64')
+    codes[resistivity == thresholds[0]] = 0
+    codes[np.isnan(resistivity)] = -1
+    return codes
+
+def conf_thresholds(Resi_conf_df, classes=None):
+    """
+    Class boundaries from a confidence interval dataframe with one <class>_conf column per class. The first
+    boundary is the upper bound of the first class and the last one the lower bound of the last class, as in the
+    three class transform; boundaries between two interior classes are the geometric midpoint of their interval
+    centers. With two classes the boundary is the geometric midpoint of the two facing bounds.
+    :param Resi_conf_df: confidence interval dataframe from lithology_connect.packup or bootstrap_confidence
+    :param classes: lithology vocabulary, anything accepted by tools.lithology_classes
+    :return: array of len(classes) - 1 boundaries
+    """
+    columns = ['{}_conf'.format(column) for column in tools.class_columns(classes)]
+    missing = [column for column in columns if column not in Resi_conf_df.columns]
+    if missing:
+        raise ValueError('Resi_conf_df has no {} columns'.format(missing))
+    if len(columns) < 2:
+        raise ValueError('At least two classes are needed, got {}'.format(columns))
+    lower = Resi_conf_df[columns].iloc[0].to_numpy(dtype='float64')
+    upper = Resi_conf_df[columns].iloc[1].to_numpy(dtype='float64')
+    if len(columns) == 2:
+        return np.sqrt(upper[:1] * lower[1:])
+    center = np.sqrt(lower * upper)
+    interior = np.sqrt(center[1:-2] * center[2:-1])
+    return np.concatenate([upper[:1], interior, lower[-1:]])
+
+def _coordinates(dataframe):
+    return ['X', 'Y'] if {'X', 'Y'}.issubset(dataframe.columns) else ['UTMX', 'UTMY']
+
+def _region_codes(ttem_data, regions, n_class, threshold_columns=None, crs=None):
+    """
+    Classify every sounding with the thresholds of the region it falls in. Soundings are looked up once per unique
+    X/Y in the spatial index of the regions, and the first region wins where regions overlap.
+    :return: int64 codes from 0, -1 for nan resistivity or soundings outside every region
+    """
+    if threshold_columns is None:
+        threshold_columns = list(regions.drop(columns=regions.geometry.name).select_dtypes('number').columns)
+        if len(threshold_columns) != n_class - 1:
+            raise ValueError('regions needs {} threshold columns, got the numeric columns {}, pass threshold_columns '
+                             'to pick them'.format(n_class - 1, threshold_columns))
+    threshold_columns = list(threshold_columns)
+    missing = [column for column in threshold_columns if column not in regions.columns]
+    if missing:
+        raise ValueError('regions has no {} columns'.format(missing))
+    if len(threshold_columns) != n_class - 1:
+        raise ValueError('{} classes need {} threshold columns, got {}'.format(n_class, n_class - 1,
+                                                                               threshold_columns))
+    ttem_crs = getattr(ttem_data, 'crs', None)
+    if ttem_crs is not None and crs is not None and not pyproj.CRS(ttem_crs).equals(crs):
+        raise ValueError('ttem_data is in {} but crs is {}'.format(ttem_crs, crs))
+    crs = ttem_crs if ttem_crs is not None else crs
+    if regions.crs is not None:
+        if crs is None:
+            raise ValueError('The regions are in {} but ttem_data has no crs, pass the crs of the tTEM '
+                             'coordinates'.format(regions.crs))
+        if not regions.crs.equals(crs):
+            regions = regions.to_crs(crs)
+    xy = ttem_data[_coordinates(ttem_data)].to_numpy(dtype='float64')
+    sounding_xy, sounding = np.unique(xy, axis=0, return_inverse=True)
+    points = gpd.points_from_xy(sounding_xy[:, 0], sounding_xy[:, 1])
+    point_index, region_index = regions.sindex.query(points, predicate='intersects')
+    order = np.lexsort((region_index, point_index))
+    point_index, first = np.unique(point_index[order], return_index=True)
+    sounding_region = np.full(len(sounding_xy), -1, dtype='int64')
+    sounding_region[point_index] = region_index[order][first]
+    cell_region = sounding_region[sounding.ravel()]
+    resistivity = ttem_data['Resistivity'].to_numpy(dtype='float64')
+    thresholds = regions[threshold_columns].to_numpy(dtype='float64')
+    codes = np.full(len(resistivity), -1, dtype='int64')
+    for region in np.unique(cell_region[cell_region >= 0]):
+        cell = cell_region == region
+        codes[cell] = classify(resistivity[cell], thresholds[region])
+    outside = (sounding_region < 0).sum()
+    if outside > 0:
+        print('{} soundings are outside every region and left unclassified'.format(outside))
+    return codes
+
+def rock_transform(ttem_data, Resi_conf_df=None, classes=None, inplace=False, thresholds=None,
+                   threshold_columns=None, crs=None):
+    """
+    Classify tTEM resistivity into the lithology classes with the bootstrap confidence intervals. Identity is an \
+    ordered categorical of the class names (e.g. 'fine grain', formerly 'Fine_grain') and Identity_n the class \
+    number (first class is 1). Unclassified cells (nan resistivity) are NaN in Identity and 0 in Identity_n.
+    :param ttem_data: tTEM dataframe
+    :param Resi_conf_df: confidence interval dataframe from lithology_connect.packup, see conf_thresholds
+    :param classes: lithology vocabulary, anything accepted by tools.lithology_classes
+    :param inplace: only add Identity_n to ttem_data instead of returning a copy with both columns
+    :param thresholds: class boundaries used instead of Resi_conf_df, either one vector of len(classes) - 1 values \
+    or a GeoDataFrame of regions with a polygon geometry and len(classes) - 1 threshold columns in class order
+    :param threshold_columns: threshold columns of the regions in class order, default None takes the numeric \
+    columns of the regions
+    :param crs: crs of the tTEM coordinates when ttem_data is not a GeoDataFrame, needed when the regions have a crs
+    :return: copy of ttem_data with Identity and Identity_n columns, or ttem_data itself when inplace
+    """
+    dtype = tools.lithology_dtype(classes)
+    n_class = len(dtype.categories)
+    if isinstance(thresholds, gpd.GeoDataFrame):
+        codes = _region_codes(ttem_data, thresholds, n_class, threshold_columns, crs)
+    else:
+        if thresholds is None:
+            if Resi_conf_df is None:
+                raise ValueError('Either Resi_conf_df or thresholds is required')
+            thresholds = conf_thresholds(Resi_conf_df, classes)
+        thresholds = np.asarray(thresholds, dtype='float64').ravel()
+        if len(thresholds) != n_class - 1:
+            raise ValueError('{} classes need {} thresholds, got {}'.format(n_class, n_class - 1, len(thresholds)))
+        codes = classify(ttem_data['Resistivity'].to_numpy(dtype='float64'), thresholds)
+    if inplace:
+        ttem_data['Identity_n'] = codes + 1
+        return ttem_data
     rock_trans = ttem_data.copy()
-    rock_trans["Identity"] = np.nan
-    rock_trans["Identity_n"] = np.nan
-    output_df = pd.DataFrame(columns=rock_trans.columns)
-    conditionlist = [
-        (ttem_data["Resistivity"] <= Resi_conf_df.Fine_conf.iloc[1]),
-        ((Resi_conf_df.Coarse_conf.iloc[0] >ttem_data["Resistivity"])
-         &(ttem_data["Resistivity"]>Resi_conf_df.Fine_conf.iloc[1])),
-        (ttem_data["Resistivity"] >= Resi_conf_df.Coarse_conf.iloc[0])
-    ]
-    choicelist = [1, 2, 3]
-    choicelist2 = ["Fine_grain","Mix_grain","Coarse_grain"]
-    rock_trans["Identity"] = np.select(conditionlist, choicelist2)
-    rock_trans["Identity_n"] = np.select(conditionlist, choicelist)
+    rock_trans['Identity'] = pd.Categorical.from_codes(codes, dtype=dtype)
+    rock_trans['Identity_n'] = codes + 1
     return rock_trans
+
+def probability_transform(ttem_data, replicates, classes=None):
+    """
+    Probabilistic rock transform from the bootstrap replicates instead of one confidence interval per class. Each
+    replicate gives the thresholds between adjacent classes as the geometric midpoint of their resistivity, and a
+    cell falls in class k for the share of replicates whose thresholds put it there. The thresholds of every
+    boundary are sorted once and each cell is counted with searchsorted, so the memory does not grow with the
+    number of replicates. Replicates with a non-positive or non-finite resistivity are left out.
+    :param ttem_data: tTEM dataframe
+    :param replicates: output of lithology_connect.bootstrap, one array of replicate resistivity per class, or a \
+    (n_boot, n_class) array
+    :param classes: lithology vocabulary, anything accepted by tools.lithology_classes
+    :return: copy of ttem_data with a P_<class> probability column per class, the normalized Entropy (0 certain, \
+    1 all classes equally likely), the most likely class as Identity and Identity_n
+    """
+    dtype = tools.lithology_dtype(classes)
+    replicates = np.asarray(replicates, dtype='float64')
+    if replicates.ndim != 2:
+        raise ValueError('replicates has to be one array per class')
+    if replicates.shape[0] == len(dtype.categories) and replicates.shape[1] != len(dtype.categories):
+        replicates = replicates.T
+    if replicates.shape[1] != len(dtype.categories):
+        raise ValueError('Got replicates of {} classes for {}'.format(replicates.shape[1], list(dtype.categories)))
+    valid = np.all(np.isfinite(replicates) & (replicates > 0), axis=1)
+    if not valid.any():
+        raise ValueError('No bootstrap replicate has a positive resistivity for every class')
+    replicates = replicates[valid]
+    thresholds = np.sqrt(replicates[:, :-1] * replicates[:, 1:])
+    thresholds = np.sort(np.maximum.accumulate(thresholds, axis=1), axis=0)
+    resistivity = ttem_data['Resistivity'].to_numpy(dtype='float64')
+    n_boot = len(thresholds)
+    # share of replicates with the cell at or below each boundary, same tie rules as classify
+    cumulative = np.empty((len(resistivity), thresholds.shape[1] + 1))
+    cumulative[:, 0] = n_boot - np.searchsorted(thresholds[:, 0], resistivity, side='left')
+    for k in range(1, thresholds.shape[1]):
+        cumulative[:, k] = n_boot - np.searchsorted(thresholds[:, k], resistivity, side='right')
+    cumulative[:, -1] = n_boot
+    cumulative = np.maximum.accumulate(cumulative, axis=1) / n_boot
+    probability = np.diff(cumulative, axis=1, prepend=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = np.where(probability > 0, probability * np.log(1 / probability), 0).sum(axis=1)
+    if probability.shape[1] > 1:
+        entropy = entropy / np.log(probability.shape[1])
+    codes = probability.argmax(axis=1)
+    missing = np.isnan(resistivity)
+    probability[missing] = np.nan
+    entropy[missing] = np.nan
+    codes[missing] = -1
+    rock_trans = ttem_data.copy()
+    for column, values in zip(tools.class_columns(classes), probability.T):
+        rock_trans['P_{}'.format(column)] = values
+    rock_trans['Entropy'] = entropy
+    rock_trans['Identity'] = pd.Categorical.from_codes(codes, dtype=dtype)
+    rock_trans['Identity_n'] = codes + 1
+    return rock_trans
+
 #def pct_count_map(rk_transform_result):
     #groups = rk_transform_result.groupby(['UTMX','UTMY'])
     #for name, group in groups:
 
-def pct_count(rk_transform_result, grain=False):
-    grainsum = rk_transform_result.groupby(['UTMX', 'UTMY', 'Identity']).agg({'Thickness':'sum'})
-    grainsum.reset_index(inplace=True)
-    thicksum = rk_transform_result.groupby(['UTMX', 'UTMY']).agg({'Thickness': 'sum'})
-    thicksum.rename(columns={'Thickness': 'T_sum'}, inplace=True)
-    thicksum.reset_index(inplace=True)
-    ratio = pd.merge(grainsum, thicksum, on=['UTMX', 'UTMY'])
-    ratio['ratio'] = round(ratio['Thickness'].div(ratio['T_sum']), 2)
+def pct_count(rk_transform_result, grain=False, depth_limit=None, classes=None):
+    """
+    Thickness ratio of every lithology class per sounding. Soundings are keyed by integer codes of their X/Y (UTMX/UTMY
+    for older outputs) and the class thickness is summed with one np.bincount over the combined sounding and class
+    key. Unclassified layers count towards T_sum but not towards any class.
+    :param rk_transform_result: output of rock_transform
+    :param grain: only keep the ratio of this class (class name, column name or the old Fine_grain style label), \
+    default False keeps all
+    :param depth_limit: only count the layers within this depth window, either the bottom depth (e.g. 30 for the \
+    upper 30 m) or (top, bottom); layers crossing the window are clipped
+    :param classes: lithology vocabulary, anything accepted by tools.lithology_classes
+    :return: one row per sounding with X, Y, T_sum and one ratio column per class
+    """
+    coordinate = _coordinates(rk_transform_result)
+    columns = tools.class_columns(classes)
+    xy = rk_transform_result[coordinate].to_numpy(dtype='float64')
+    sounding_xy, sounding = np.unique(xy, axis=0, return_inverse=True)
+    sounding = sounding.ravel()
+    code = rk_transform_result['Identity_n'].to_numpy(dtype='int64') - 1
+    thickness = rk_transform_result['Thickness'].to_numpy(dtype='float64')
+    if depth_limit is not None:
+        top, bottom = (0, depth_limit) if np.isscalar(depth_limit) else depth_limit
+        layer_top = rk_transform_result['Depth_top'].to_numpy(dtype='float64')
+        layer_bottom = rk_transform_result['Depth_bottom'].to_numpy(dtype='float64')
+        thickness = np.clip(np.minimum(layer_bottom, bottom) - np.maximum(layer_top, top), 0, None)
+    n_sounding, n_class = len(sounding_xy), len(columns)
+    thick_sum = np.bincount(sounding, weights=thickness, minlength=n_sounding)
+    classified = (code >= 0) & (code < n_class)
+    grain_sum = np.bincount(sounding[classified] * n_class + code[classified], weights=thickness[classified],
+                            minlength=n_sounding * n_class).reshape(n_sounding, n_class)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = grain_sum / thick_sum[:, None]
+    output = pd.DataFrame(ratio, columns=columns)
+    output.insert(0, 'T_sum', thick_sum)
+    output.insert(0, coordinate[1], sounding_xy[:, 1])
+    output.insert(0, coordinate[0], sounding_xy[:, 0])
     if grain is not False:
-        try:
-            ratio = ratio[ratio['Identity'] == grain]
-        except:
-            raise ('{} is not one of Fine_grain, Mix_grain, or Coarse_grain keyword'.format(grain))
-    return ratio
+        names = [str(name) for name in tools.lithology_dtype(classes).categories]
+        # the labels of the original transform (Fine_grain, Mix_grain, Coarse_grain) are kept as aliases
+        legacy = ['{}_grain'.format(column) for column in columns]
+        if grain in legacy:
+            grain = columns[legacy.index(grain)]
+        elif str(grain).lower().replace('_', ' ') in names:
+            grain = columns[names.index(str(grain).lower().replace('_', ' '))]
+        if grain not in columns:
+            raise ValueError('{} is not one of the lithology classes'.format(grain))
+        output = output[coordinate + ['T_sum', grain]]
+    return output
 '''
     for index, row in ttem_data.iterrows():
         if row.Resistivity <= Resi_conf_df.Fine_conf.iloc[1]:
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# water_store.py
+import pathlib
+from pathlib import Path
+import json
+import os
+import numpy as np
+import pandas as pd
+
+class WaterStore:
+    """
+    Partitioned columnar store of water level series, one directory per site. Every append writes the rows newer
+    than the stored ones as a new numpy .npz part (time as int64 nanoseconds, one float column per level), and the
+    site manifest (manifest.json) keeps the time range of every part and the site metadata, so range queries only
+    open the parts that overlap the range. Nothing outside numpy and pandas is needed.\n
+    :param path: A string or pathlib.PurePath object of the store directory, created if missing
+    """
+    COLUMNS = ('wt_blw_gd', 'wt_abv_ngvd29', 'wt_abv_navd88')
+
+    def __init__(self, path: str | pathlib.PurePath):
+        self.path = Path(path).expanduser()
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def sites(self) -> list:
+        """
+        :return: sorted list of the stored site numbers
+        """
+        return sorted(site.name for site in self.path.iterdir() if site.joinpath('manifest.json').exists())
+
+    def _manifest(self, site: str) -> dict:
+        manifest_path = self.path.joinpath(site, 'manifest.json')
+        if not manifest_path.exists():
+            return {'site_no': site, 'agent': 'USGS', 'metadata': {}, 'parts': []}
+        with open(manifest_path, 'r') as file:
+            return json.load(file)
+
+    def _write_manifest(self, site: str, manifest: dict):
+        # replace the manifest in one step so readers never see a half written file
+        manifest_path = self.path.joinpath(site, 'manifest.json')
+        temp_path = manifest_path.with_suffix('.tmp')
+        with open(temp_path, 'w') as file:
+            json.dump(manifest, file, indent=1, default=str)
+        os.replace(temp_path, manifest_path)
+
+    def append(self, water: pd.DataFrame) -> int:
+        """
+        Append format_usgs_water results. Rows at or before the last stored time of their site are skipped, so
+        appending a full re-download only adds the new records. The attrs of the frame are kept as site metadata.
+        :param water: dataframe with well_no, time and the water level columns, may hold several sites
+        :return: number of appended rows
+        """
+        appended = 0
+        for site, group in water.groupby(water['well_no'].astype(str), sort=True):
+            manifest = self._manifest(site)
+            time = group['time'].to_numpy(dtype='datetime64[ns]').view('int64')
+            order = np.argsort(time, kind='stable')
+            time = time[order]
+            keep = np.r_[True, time[1:] != time[:-1]]
+            if manifest['parts']:
+                keep &= time > manifest['parts'][-1]['end']
+            if water.attrs:
+                manifest['metadata'] = {key: value for key, value in water.attrs.items()
+                                        if not isinstance(value, (list, dict))}
+            if 'agent' in group.columns:
+                manifest['agent'] = str(group['agent'].iloc[0])
+            if keep.any():
+                columns = {'time': time[keep]}
+                for column in self.COLUMNS:
+                    values = group[column].to_numpy(dtype='float64') if column in group.columns \
+                        else np.full(len(group), np.nan)
+                    columns[column] = values[order][keep]
+                part = 'part-{:05d}.npz'.format(len(manifest['parts']))
+                self.path.joinpath(site).mkdir(exist_ok=True)
+                np.savez(self.path.joinpath(site, part), **columns)
+                manifest['parts'].append({'file': part,
+                                          'start': int(columns['time'][0]),
+                                          'end': int(columns['time'][-1]),
+                                          'rows': int(keep.sum())})
+                appended += int(keep.sum())
+            self._write_manifest(site, manifest)
+        return appended
+
+    def read(self, sites: list | str = None, start=None, end=None) -> pd.DataFrame:
+        """
+        Water levels of the given sites between start and end (both included).
+        :param sites: site number or list of site numbers, default None reads every site
+        :param start: anything accepted by pd.Timestamp, default None from the first record
+        :param end: anything accepted by pd.Timestamp, default None to the last record
+        :return: dataframe in the format_usgs_water layout, sorted by site and time
+        """
+        if sites is None:
+            sites = self.sites()
+        elif isinstance(sites, str):
+            sites = [sites]
+        start = np.iinfo('int64').min if start is None else pd.Timestamp(start).as_unit('ns').value
+        end = np.iinfo('int64').max if end is None else pd.Timestamp(end).as_unit('ns').value
+        frames = []
+        for site in sites:
+            manifest = self._manifest(str(site))
+            for part in manifest['parts']:
+                if part['end'] < start or part['start'] > end:
+                    continue
+                with np.load(self.path.joinpath(str(site), part['file'])) as columns:
+                    time = columns['time']
+                    lower = np.searchsorted(time, start, side='left')
+                    upper = np.searchsorted(time, end, side='right')
+                    frame = pd.DataFrame({column: columns[column][lower:upper] for column in self.COLUMNS})
+                frame.insert(0, 'time', time[lower:upper].view('datetime64[ns]'))
+                frame.insert(0, 'well_no', str(site))
+                frame.insert(0, 'agent', manifest['agent'])
+                frames.append(frame)
+        if not frames:
+            return pd.DataFrame({'agent': pd.Series(dtype=str), 'well_no': pd.Series(dtype=str),
+                                 'time': pd.Series(dtype='datetime64[ns]'),
+                                 **{column: pd.Series(dtype='float64') for column in self.COLUMNS}})
+        return pd.concat(frames, ignore_index=True)
+
+    def metadata(self, sites: list = None) -> pd.DataFrame:
+        """
+        :param sites: list of site numbers, default None for every site
+        :return: one row of stored metadata per site
+        """
+        sites = self.sites() if sites is None else sites
+        return pd.DataFrame([{'well_no': site, **self._manifest(str(site))['metadata']} for site in sites])
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# water_table.py
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from scipy.spatial import cKDTree
+from ttemtoolbox.core import lithology_connect, water_store
+
+def water_points(water: pd.DataFrame, meta: pd.DataFrame, start=None, end=None,
+                 level: str = 'wt_abv_navd88', crs=None) -> gpd.GeoDataFrame:
+    """
+    One water table elevation per well from the water level records within a date window, located with the well
+    metadata and projected to the tTEM crs.
+    :param water: water level records from format_usgs_water, step_water or WaterStore.read
+    :param meta: well metadata with well_no, lon and lat columns (step_water meta or WaterStore.metadata)
+    :param start: first date of the window, anything accepted by pd.Timestamp, default None from the first record
+    :param end: last date of the window, default None to the last record
+    :param level: water level column to use, e.g. 'wt_abv_ngvd29'
+    :param crs: crs of the tTEM data, default None keeps longitude/latitude
+    :return: one point per well with well_no, water_elevation (median within the window) and n_record
+    """
+    time = pd.to_datetime(water['time'])
+    window = water[level].notna().to_numpy().copy()
+    if start is not None:
+        window &= (time >= pd.Timestamp(start)).to_numpy()
+    if end is not None:
+        window &= (time <= pd.Timestamp(end)).to_numpy()
+    selected = water[window]
+    elevation = selected.groupby(selected['well_no'].astype(str))[level].agg(['median', 'size'])
+    elevation.columns = ['water_elevation', 'n_record']
+    points = _locate(elevation.reset_index(names='well_no'), meta, crs)
+    if points.empty:
+        raise ValueError('No water level record with a known location between {} and {}'.format(start, end))
+    return points
+
+def _locate(elevation: pd.DataFrame, meta: pd.DataFrame, crs=None) -> gpd.GeoDataFrame:
+    # join lon/lat of the metadata by well_no and project to the tTEM crs
+    location = meta.assign(well_no=meta['well_no'].astype(str)).drop_duplicates('well_no').set_index('well_no')
+    elevation = elevation.join(location[['lon', 'lat']].astype('float64'), on='well_no', how='inner')
+    elevation = elevation.reset_index(drop=True)
+    points = gpd.GeoDataFrame(elevation, geometry=gpd.points_from_xy(elevation['lon'], elevation['lat']),
+                              crs='EPSG:4326')
+    if crs is not None:
+        points = points.to_crs(crs)
+    points['X'] = points.geometry.x
+    points['Y'] = points.geometry.y
+    return points
+
+def levels_at(water: pd.DataFrame, dates, level: str = 'wt_abv_navd88', method: str = 'linear',
+              window: float = None) -> pd.DataFrame:
+    """
+    Water level of every site at every date, all sites at once. The records are sorted once on a composite
+    site + time key and every (site, date) pair finds its neighbouring records with one searchsorted.
+    'linear' interpolates between the records before and after the date (no extrapolation), 'nearest' takes the
+    closest record, 'seasonal' fits level = a + b*t + c*sin(2*pi*t) + d*cos(2*pi*t) (t in years) per site and
+    evaluates it at the date.
+    :param water: water level records with well_no, time and the level column, e.g. WaterStore.read
+    :param dates: one or several dates accepted by pd.to_datetime
+    :param level: water level column to use
+    :param method: 'linear', 'nearest' or 'seasonal'
+    :param window: maximum distance in days to the record(s) used, NaN beyond it, default None for no limit.
+    Ignored by 'seasonal'
+    :return: dataframe with well_no, date, water_elevation and gap (days to the closest record)
+    """
+    if method not in ('linear', 'nearest', 'seasonal'):
+        raise ValueError("method has to be 'linear', 'nearest' or 'seasonal' not {}".format(method))
+    dates = pd.to_datetime(pd.Index(np.atleast_1d(dates))).as_unit('ns')
+    water = water[water[level].notna()]
+    site, code = np.unique(water['well_no'].astype(str).to_numpy(), return_inverse=True)
+    code = code.ravel()
+    day = 86400e9
+    time = pd.to_datetime(water['time']).to_numpy(dtype='datetime64[ns]').view('int64')
+    origin = min(time.min(), dates.asi8.min()) if len(time) else dates.asi8.min()
+    days = (time - origin) / day
+    query_days = (dates.asi8 - origin) / day
+    order = np.lexsort((days, code))
+    code, days = code[order], days[order]
+    value = water[level].to_numpy(dtype='float64')[order]
+    first = np.searchsorted(code, np.arange(len(site)), side='left')
+    last = np.searchsorted(code, np.arange(len(site)), side='right')
+
+    query_site = np.repeat(np.arange(len(site)), len(dates))
+    query_time = np.tile(query_days, len(site))
+    key, query_key = lithology_connect._group_keys(code, days, (query_site, query_time))
+    right = np.searchsorted(key, query_key, side='left')
+    left = right - 1
+    has_left = left >= first[query_site]
+    has_right = right < last[query_site]
+    left_gap = np.where(has_left, query_time - days[np.clip(left, 0, None)], np.inf)
+    right_gap = np.where(has_right, days[np.clip(right, None, len(days) - 1)] - query_time, np.inf)
+    gap = np.minimum(left_gap, right_gap)
+
+    if method == 'nearest':
+        pick = np.where(right_gap <= left_gap, right, left)
+        elevation = np.where(np.isfinite(gap), value[np.clip(pick, 0, len(value) - 1)], np.nan)
+        if window is not None:
+            elevation[gap > window] = np.nan
+    elif method == 'linear':
+        exact = right_gap == 0
+        bracket = has_left & has_right
+        lower = value[np.clip(left, 0, len(value) - 1)]
+        upper = value[np.clip(right, None, len(value) - 1)]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            elevation = lower + (upper - lower) * left_gap / (left_gap + right_gap)
+        elevation = np.where(exact, upper, np.where(bracket, elevation, np.nan))
+        if window is not None:
+            elevation[~exact & (np.maximum(left_gap, right_gap) > window)] = np.nan
+    else:
+        elevation = _seasonal(code, days / 365.25, value, len(site))(query_site, query_time / 365.25)
+    return pd.DataFrame({'well_no': site[query_site], 'date': np.tile(dates.to_numpy(), len(site)),
+                         'water_elevation': elevation, 'gap': gap})
+
+def _seasonal(code: np.ndarray, years: np.ndarray, value: np.ndarray, n_site: int, min_record: int = 6):
+    # least squares of a + b*t + c*sin + d*cos for every site together: the 4x4 normal equations are summed
+    # per site with bincount and solved as one stack
+    count = np.bincount(code, minlength=n_site)
+    center = np.bincount(code, weights=years, minlength=n_site) / np.maximum(count, 1)
+
+    def design(site, t):
+        phase = 2 * np.pi * t
+        return np.stack([np.ones_like(t), t - center[site], np.sin(phase), np.cos(phase)], axis=1)
+
+    a = design(code, years)
+    normal = np.empty((n_site, 4, 4))
+    rhs = np.empty((n_site, 4))
+    for i in range(4):
+        rhs[:, i] = np.bincount(code, weights=a[:, i] * value, minlength=n_site)
+        for j in range(i, 4):
+            normal[:, i, j] = normal[:, j, i] = np.bincount(code, weights=a[:, i] * a[:, j], minlength=n_site)
+    coefficient = np.einsum('sij,sj->si', np.linalg.pinv(normal), rhs)
+    coefficient[count < min_record] = np.nan
+
+    def evaluate(site, t):
+        return np.einsum('ij,ij->i', design(site, t), coefficient[site])
+    return evaluate
+
+def survey_water_points(store, dates, meta: pd.DataFrame = None, level: str = 'wt_abv_navd88',
+                        method: str = 'linear', window: float = None, crs=None) -> dict:
+    """
+    Water table points of every site in the water store at every survey date, ready for
+    interpolate_water_table / split_water_table.
+    :param store: WaterStore or path of the store
+    :param dates: survey acquisition date(s)
+    :param meta: well metadata with well_no, lon and lat, default None uses the store metadata
+    :param level: water level column to use
+    :param method: 'linear', 'nearest' or 'seasonal', see levels_at
+    :param window: maximum distance in days to the record(s) used, see levels_at
+    :param crs: crs of the tTEM data
+    :return: dict of survey date (pd.Timestamp) and GeoDataFrame of the sites with a level at that date
+    """
+    if not isinstance(store, water_store.WaterStore):
+        store = water_store.WaterStore(store)
+    meta = store.metadata() if meta is None else meta
+    if not {'lon', 'lat'}.issubset(meta.columns):
+        raise ValueError('Well metadata has no lon/lat, re-download the wells or pass meta')
+    levels = levels_at(store.read(), dates, level=level, method=method, window=window)
+    levels = _locate(levels[levels['water_elevation'].notna()], meta, crs)
+    points = {}
+    for date in pd.to_datetime(pd.Index(np.atleast_1d(dates))):
+        points[date] = levels[levels['date'] == date].reset_index(drop=True)
+        print('{} wells with water level at {}'.format(len(points[date]), date.date()))
+    return points
+
+def interpolate_water_table(ttem_data: pd.DataFrame, points: pd.DataFrame, method: str = 'idw', k: int = 8,
+                            power: float = 2) -> np.ndarray:
+    """
+    Water table elevation at every tTEM row. Each sounding is evaluated once and all soundings are queried in one
+    KD-tree call.
+    :param ttem_data: tTEM dataframe with X and Y
+    :param points: water table points with X, Y and water_elevation, see water_points
+    :param method: 'nearest' takes the closest well, 'idw' the inverse distance weighted mean of the k closest
+    :param k: number of wells used by 'idw'
+    :param power: distance power of 'idw'
+    :return: array of water table elevation per row of ttem_data
+    """
+    if method not in ('nearest', 'idw'):
+        raise ValueError("method has to be 'nearest' or 'idw' not {}".format(method))
+    well_xy = points[['X', 'Y']].to_numpy(dtype='float64')
+    well_elevation = points['water_elevation'].to_numpy(dtype='float64')
+    # wells without a level or a location can not take part
+    valid = np.isfinite(well_elevation) & np.isfinite(well_xy).all(axis=1)
+    if not valid.any():
+        raise ValueError('No water table point with a location and a water_elevation to interpolate from')
+    well_xy, well_elevation = well_xy[valid], well_elevation[valid]
+    xy = ttem_data[['X', 'Y']].to_numpy(dtype='float64')
+    sounding_xy, inverse = np.unique(xy, axis=0, return_inverse=True)
+    k = 1 if method == 'nearest' else min(k, len(well_xy))
+    distance, index = cKDTree(well_xy).query(sounding_xy, k=k)
+    distance = distance.reshape(len(sounding_xy), -1)
+    index = index.reshape(len(sounding_xy), -1)
+    with np.errstate(divide='ignore'):
+        weight = 1 / distance ** power
+    # a sounding on top of a well takes the well value
+    exact = distance[:, 0] == 0
+    weight[exact] = 0
+    weight[exact, 0] = 1
+    elevation = (weight * well_elevation[index]).sum(axis=1) / weight.sum(axis=1)
+    return elevation[inverse.ravel()]
+
+def split_water_table(ttem_data: pd.DataFrame, water_elevation: np.ndarray | pd.DataFrame, **kwargs) -> tuple:
+    """
+    Split tTEM layers at the water table with one mask. A layer whose bottom (Elevation_End) is at or above the
+    water table is vadose, a layer whose bottom is below it is saturated. Layers without a water table elevation
+    (NaN) are left out of both parts.
+    :param ttem_data: tTEM dataframe
+    :param water_elevation: water table elevation per row, or water table points passed to interpolate_water_table
+    :param kwargs: method, k and power of interpolate_water_table
+    :return: vadose and saturated parts of ttem_data, both with a Water_elevation column
+    """
+    if isinstance(water_elevation, pd.DataFrame):
+        water_elevation = interpolate_water_table(ttem_data, water_elevation, **kwargs)
+    ttem_data = ttem_data.assign(Water_elevation=np.asarray(water_elevation, dtype='float64'))
+    bottom = ttem_data['Elevation_End'].to_numpy(dtype='float64')
+    water = ttem_data['Water_elevation'].to_numpy(dtype='float64')
+    known = ~np.isnan(water)
+    if not known.all():
+        print('{} layers have no water table elevation and are left out of the split'.format((~known).sum()))
+    vadose = known & (bottom >= water)
+    return ttem_data[vadose], ttem_data[known & ~vadose]
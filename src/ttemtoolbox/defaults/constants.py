@@ -14,10 +14,20 @@ LITHOLOGY_COLUMN_NAMES_KEYWORD = ('lithology','litho', 'keyword')
 LITHOLOGY_COLUMN_NAMES_BORE = ('bore','borehole')
 LITHOLOGY_COLUMN_NAMES_DEPTH_TOP = ( 'depth1', 'depth_1', 'depthtop','depth_top')
 LITHOLOGY_COLUMN_NAMES_DEPTH_BOTTOM = ( 'depth2',  'depth_2', 'depthbottom', 'depth_bottom')
+LITHOLOGY_COLUMN_NAMES_CLASS = ('class', 'lithology_class', 'category')
+# Default lithology vocabulary, ordered from the least to the most resistive class
+LITHOLOGY_CLASSES = ('fine grain', 'mix grain', 'coarse grain')
 LOCATION_SHEET_NAMES = ('location', 'coordinates')
 LOCATION_COLUMN_NAMES_UTMX = ('utmx', 'utm_x')
 LOCATION_COLUMN_NAMES_UTMY = ('utmy', 'utm_y')
 LOCATION_COLUMN_NAMES_LAT = ( 'lat',  'latitude', 'y')
 LOCATION_COLUMN_NAMES_LON = ('lon',  'longitude', 'x')
 LOCATION_COLUMN_NAMES_ELEVATION = ( 'elevation', 'elev',  'elevation_m',  'elev_m', 'elevation(m)', 'elev(m)','z')
-
+# USGS NWIS services, can be pointed to a mirror or a local server
+USGS_GWLEVELS_URL = 'https://nwis.waterdata.usgs.gov/nwis/gwlevels'
+USGS_INVENTORY_URL = 'https://waterdata.usgs.gov/nwis/inventory'
+USGS_SITE_URL = 'https://waterservices.usgs.gov/nwis/site/'
+# Default water level store, outside the output folder so cleaning the output keeps the records
+WATER_STORE_PATH = '~/.ttemtoolbox/water_store'
+# horizontal datum codes of the NWIS coordinates, well locations are converted to EPSG:4326
+USGS_DATUM_CRS = {'NAD27': 'EPSG:4267', 'NAD83': 'EPSG:4269', 'WGS84': 'EPSG:4326'}
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 from ttemtoolbox import process_ttem, process_gamma, process_well, process_water, lithology_connect
+from ttemtoolbox.core import water_store
+from ttemtoolbox.defaults import constants
 from ttemtoolbox import tools
 from ttemtoolbox import __version__
 from pathlib import Path
@@ -129,11 +131,13 @@ def step_lithology(config: dict, inps: dict)-> gpd.GeoDataFrame:
         config['lithology_resample'] = inps['resample']
     if inps.get('unit'):
         config['lithology_unit'] = inps['unit']
-    if Path(config['well_path']).is_file():
+    if Path(config['well_path']).exists():
         lithology = process_well.ProcessWell(
             fname = config['well_path'],
             crs=config['lithology_crs'],
-            unit = config['lithology_unit']
+            unit = config['lithology_unit'],
+            lithology_classes = config.get('lithology_classes'),
+            workers = config.get('lithology_workers')
         )
     else:
         raise TypeError('Lithology file not found in {}'.format(config['well_path']))
@@ -154,20 +158,23 @@ def step_water(config : dict, inps: dict) -> tuple:
     print('Step4: Process water level data')
     if inps.get('well_no'):
         config['USGS_well_NO'] = inps['well_no']
-    concat_list = []
-    meta_data_list = []
-    for well in config['USGS_well_NO']:
-        water = process_water.format_usgs_water(well, config['water_temp'])
-        concat_list.append(water)
-        meta_data_list.append(pd.DataFrame(water.attrs, index=[0]))
+    concat_list = process_water.download_usgs_water(config['USGS_well_NO'], config['water_temp'],
+                                                    max_age=config.get('water_cache_max_age'),
+                                                    workers=config.get('water_workers') or 8,
+                                                    batch_size=config.get('water_batch_size'))
+    meta_data_list = [pd.DataFrame(water.attrs, index=[0]) for water in concat_list]
+    store = water_store.WaterStore(config.get('water_store') or constants.WATER_STORE_PATH)
+    appended = sum(store.append(water) for water in concat_list)
+    print('{} new water level records saved in {}'.format(appended, store.path))
     water = pd.concat(concat_list)
     water.reset_index(drop=True, inplace=True)
     meta = pd.concat(meta_data_list)
     meta.reset_index(drop=True, inplace=True)
-    with pd.ExcelWriter(config['deliver'].joinpath('water_level.xlsx')) as writer:
-        water.to_excel(writer, sheet_name='water_level', index=False)
-        meta.to_excel(writer, sheet_name='metadata', index=False)
-    print('Water level data saved in {}'.format(config['deliver'].joinpath('water_level.xlsx')))
+    if config.get('water_excel'):
+        with pd.ExcelWriter(config['deliver'].joinpath('water_level.xlsx')) as writer:
+            water.to_excel(writer, sheet_name='water_level', index=False)
+            meta.to_excel(writer, sheet_name='metadata', index=False)
+        print('Water level data saved in {}'.format(config['deliver'].joinpath('water_level.xlsx')))
     return water, meta
 
 
@@ -185,7 +192,8 @@ def step_connect(config: dict, inps:dict,
                                 crs=config['lithology_reproject_crs'])
     matched_ttem, matched_lithology = lithology_connect.select_closest(ttem, lithology,
                                                                        search_radius = config['search_radius'])
-    stitched = lithology_connect.ttem_well_connect(matched_ttem, matched_lithology)
+    stitched = lithology_connect.ttem_well_connect(matched_ttem, matched_lithology,
+                                                   classes=config.get('lithology_classes'))
     stitched.to_csv(Path(config['deliver']).joinpath('ttem_well_connect.csv'))
     print('connected file saved to {}'.format(Path(config['deliver']).joinpath('ttem_well_connect.csv')))
     return stitched
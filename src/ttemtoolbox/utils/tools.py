@@ -1,9 +1,11 @@
 #!/usr/bin/env python
+import numpy as np
 import pandas as pd
 import pathlib
 from pathlib import Path
 import re
 import shutil
+from ttemtoolbox.defaults import constants
 
 def keyword_search(fname, pattern):
     """
@@ -24,6 +26,85 @@ def keyword_search(fname, pattern):
         raise TypeError('fname must be dict or DataFrame')      
 
 
+def lithology_classes(source=None) -> dict:
+    """
+    Build the lithology vocabulary used to encode well log keywords. Classes are ordered from the least to the most \
+    resistive material, the order of the classes defines their integer code.
+    :param source: None to use constants.LITHOLOGY_CLASSES, a list of class names (e.g. lithology_classes in CONFIG),\
+    a dict of {keyword: class}, or a path to a csv/excel mapping file that contains a keyword column and a class column
+    :return: dict that maps every lower case keyword to its class name
+    """
+    if source is None:
+        source = constants.LITHOLOGY_CLASSES
+    if isinstance(source, dict):
+        mapping = source
+    elif isinstance(source, (list, tuple)):
+        mapping = {name: name for name in source}
+    elif isinstance(source, (str, pathlib.PurePath)):
+        source = Path(source).expanduser()
+        if Path(source).suffix in constants.CSV_EXTENSION:
+            table = pd.read_csv(source)
+        elif Path(source).suffix in constants.EXCEL_EXTENSION:
+            table = pd.read_excel(source)
+        else:
+            raise ValueError('Lithology mapping file must be one of {}'.format(
+                constants.CSV_EXTENSION + constants.EXCEL_EXTENSION))
+        match_column_keyword = keyword_search(table, constants.LITHOLOGY_COLUMN_NAMES_KEYWORD)
+        match_column_class = keyword_search(table, constants.LITHOLOGY_COLUMN_NAMES_CLASS)
+        if len(match_column_keyword) == 0 or len(match_column_class) == 0:
+            raise ValueError('No keyword and class columns found in {}'.format(source))
+        mapping = dict(zip(table[match_column_keyword[0]], table[match_column_class[0]]))
+    else:
+        raise TypeError('Lithology classes must be None, a list, a dict or a path to a mapping file')
+    mapping = {str(key).strip().lower(): str(value).strip() for key, value in mapping.items()}
+    for value in list(mapping.values()):
+        mapping.setdefault(value.lower(), value)
+    return mapping
+
+
+def lithology_dtype(classes=None) -> pd.CategoricalDtype:
+    """
+    Ordered categorical dtype of the lithology vocabulary, category codes are the integer class codes
+    :param classes: anything accepted by lithology_classes
+    :return: pd.CategoricalDtype
+    """
+    mapping = classes if isinstance(classes, dict) else lithology_classes(classes)
+    return pd.CategoricalDtype(categories=list(dict.fromkeys(mapping.values())), ordered=True)
+
+
+def encode_lithology(keyword: pd.Series, classes=None) -> pd.Series:
+    """
+    Encode well log keywords as an ordered pandas Categorical of lithology classes. Only the unique keywords are \
+    looked up, keywords outside the vocabulary become NaN (code -1).
+    :param keyword: pd.Series of lithology keywords
+    :param classes: anything accepted by lithology_classes
+    :return: categorical pd.Series
+    """
+    mapping = classes if isinstance(classes, dict) else lithology_classes(classes)
+    dtype = lithology_dtype(mapping)
+    if keyword.dtype == dtype:
+        return keyword
+    raw_codes, uniques = pd.factorize(keyword)
+    class_code = {name: code for code, name in enumerate(dtype.categories)}
+    unique_codes = [class_code.get(mapping.get(str(value).strip().lower()), -1) for value in uniques]
+    codes = np.append(np.array(unique_codes, dtype='int64'), -1)[raw_codes]
+    return pd.Series(pd.Categorical.from_codes(codes, dtype=dtype), index=keyword.index, name=keyword.name)
+
+
+def class_columns(classes=None) -> list:
+    """
+    Column names that hold per-class values, e.g. 'fine grain' -> 'Fine'. Falls back to the full class name when \
+    the first words collide.
+    :param classes: anything accepted by lithology_classes
+    :return: list of column names in class code order
+    """
+    categories = [str(name) for name in lithology_dtype(classes).categories]
+    columns = [name.split()[0].capitalize() for name in categories]
+    if len(set(columns)) != len(columns):
+        columns = [name.title().replace(' ', '') for name in categories]
+    return columns
+
+
 def skip_metadata(fname: pathlib.PurePath | str,
                   keyword: str) -> list:
     """
@@ -70,7 +151,7 @@ def type_convert(config_str: str) :
         return float(config_str)
     if config_str.startswith('[') and config_str.endswith(']'):
         config_str = config_str[1:-1].split(',')
-        config_str = [item.strip() for item in config_str]
+        config_str = [item.strip().strip('"\'') for item in config_str]
         return config_str
     return config_str
 
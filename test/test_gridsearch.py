@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# Vectorized threshold searches against the per-combination loops on the bundled well logs
+import itertools
+import pathlib
+import numpy as np
+import pandas as pd
+import pytest
+from ttemtoolbox.core import gridsearch
+from ttemtoolbox.core.process_well import ProcessWell
+from ttemtoolbox.core.rock_trans import rock_transform
+
+WELL_LOG = pathlib.Path(__file__).resolve().parents[1].joinpath('data', 'Well_log.xlsx')
+SEARCH = dict(rho_fine=2, rho_mix=5, rho_coarse=10, loop_range=8)
+
+
+@pytest.fixture(scope='module')
+def welllog():
+    welllog = ProcessWell(WELL_LOG).resample(10)
+    return welllog[welllog['Keyword_n'] > 0].reset_index(drop=True)
+
+
+@pytest.fixture(scope='module')
+def ttem(welllog):
+    # one synthetic sounding next to every bore, resistivity drawn around a typical value of each class
+    rng = np.random.default_rng(0)
+    typical = np.array([8, 20, 45])[welllog['Keyword_n'] - 1]
+    return pd.DataFrame({'ID': pd.factorize(welllog['Bore'])[0],
+                         'X': welllog['X'] + 5,
+                         'Y': welllog['Y'],
+                         'Elevation_Cell': welllog['Elevation_top'].round(2),
+                         'Resistivity': np.exp(rng.normal(np.log(typical), 0.6))})
+
+
+def _bores(welllog, ttem, n=12):
+    # wells with the most layers, and wells with a single class where every combination ties
+    size = welllog.groupby('Bore').size().sort_values(ascending=False)
+    n_class = welllog.groupby('Bore')['Keyword_n'].nunique()
+    bores = list(size.index[:n]) + list(n_class[n_class == 1].index[:4])
+    return [bore for bore in bores if not gridsearch._prepare_merge(ttem, welllog, bore).empty]
+
+
+def _best(combinations, scores, score_name, names):
+    # best score and the mean of the tied combinations, preferring rho_coarse > rho_fine, as the original loops
+    combinations = np.array(combinations, dtype='float64')
+    scores = np.nan_to_num(np.array(scores, dtype='float64'))
+    tied = combinations[np.isclose(scores, scores.max(), rtol=1e-9, atol=1e-12)]
+    preferred = tied[tied[:, -1] > tied[:, 0]]
+    if len(preferred):
+        means = preferred.mean(axis=0)
+    else:
+        means = tied.mean(axis=0)
+        means[0] = means[-1]
+    return dict(zip([score_name] + names, [scores.max()] + list(means)))
+
+
+def _loop_similarity(merge, rho_fine, rho_coarse, loop_range):
+    combinations = list(itertools.product(np.arange(rho_fine, rho_fine + loop_range),
+                                          np.arange(rho_coarse, rho_coarse + loop_range)))
+    scores = [(merge['Keyword_n'] == rock_transform(merge, thresholds=[fine, coarse])['Identity_n']).mean()
+              for fine, coarse in combinations]
+    return _best(combinations, scores, 'similiarity', ['Fine_conf', 'Coarse_conf'])
+
+
+def _loop_pearson(merge, rho_fine, rho_mix, rho_coarse, loop_range):
+    combinations = list(itertools.product(np.arange(rho_fine, rho_fine + loop_range),
+                                          np.arange(rho_mix, rho_mix + loop_range),
+                                          np.arange(rho_coarse, rho_coarse + loop_range)))
+    choicelist = [merge['Keyword_n'] == n for n in (1, 2, 3)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = [np.corrcoef(np.select(choicelist, combination), merge['Resistivity'])[0, 1]
+                  for combination in combinations]
+    return _best(combinations, scores, 'pearson', ['Fine_average', 'Mix_average', 'Coarse_average'])
+
+
+def test_value_search_matches_loop(welllog, ttem):
+    for bore in _bores(welllog, ttem):
+        merge = gridsearch._prepare_merge(ttem, welllog, bore)
+        expected = _loop_similarity(merge, 2, 10, 12)
+        best = gridsearch.value_search(ttem, welllog, bore, rho_fine=2, rho_coarse=10, loop_range=12)
+        for key in expected:
+            assert best[key] == pytest.approx(expected[key]), (bore, key)
+
+
+def test_value_search_res_matches_loop(welllog, ttem):
+    for bore in _bores(welllog, ttem):
+        merge = gridsearch._prepare_merge(ttem, welllog, bore)
+        expected = _loop_pearson(merge, 2, 5, 10, SEARCH['loop_range'])
+        best = gridsearch.value_search_res(ttem, welllog, bore, **SEARCH)
+        for key in expected:
+            assert best[key] == pytest.approx(expected[key]), (bore, key)
+
+
+def test_batch_search_matches_single_searches(welllog, ttem):
+    bores = _bores(welllog, ttem)
+    batch = gridsearch.batch_search(ttem, welllog, wins=bores, search_radius=1000, **SEARCH).set_index('Bore')
+    for bore in bores:
+        single = gridsearch.value_search(ttem, welllog, bore, rho_fine=2, rho_coarse=10, loop_range=8)
+        single.update(gridsearch.value_search_res(ttem, welllog, bore, **SEARCH))
+        for key, value in single.items():
+            assert batch.loc[bore, key] == pytest.approx(value), (bore, key)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# USGS downloads against a local stand-in for the NWIS services
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+import pytest
+from pyproj import Transformer
+from ttemtoolbox.core import process_water
+from ttemtoolbox.defaults import constants
+
+WELLS = ['375006112554801', '375006112554802', '375006112554803']
+
+
+def _rdb(sites):
+    # one or several comma separated sites in one RDB, as the gwlevels service answers
+    lines = ['# US Geological Survey groundwater levels',
+             '\t'.join(['agency_cd', 'site_no', 'lev_dt', 'lev_va', 'sl_lev_va', 'sl_datum_cd']),
+             '\t'.join(['5s', '15s', '10d', '12s', '12s', '10s'])]
+    for site in sites.split(','):
+        for day, level in (('2020-03-01', '100.00'), ('2021-03-01', '102.50')):
+            lines.append('\t'.join(['USGS', site, day, level, '{:.2f}'.format(5900 - float(level)), 'NGVD29']))
+    return '\n'.join(lines) + '\n'
+
+
+def _inventory(site):
+    return ("<html><head><title>USGS {}  37S 9W 10AAA-1</title></head><body>"
+            "Latitude  37&#176;50'06\", &nbsp; Longitude 112&#176;55'48\" &nbsp; NAD27<br />"
+            "Well depth: 300 feet below land surface.<br />"
+            "Land surface altitude:  5,900.00 feet above NGVD29".format(site))
+
+
+def _site(sites):
+    # expanded site service RDB, same location as the inventory page in decimal degrees
+    lines = ['# US Geological Survey site inventory',
+             '\t'.join(['agency_cd', 'site_no', 'station_nm', 'dec_lat_va', 'dec_long_va', 'dec_coord_datum_cd',
+                        'alt_va', 'well_depth_va']),
+             '\t'.join(['5s', '15s', '50s', '16s', '16s', '10s', '8s', '8s'])]
+    for site in sites.split(','):
+        lines.append('\t'.join(['USGS', site, '(C-37- 9)10aaa- 1', '37.835', '-112.93', 'NAD27', '5900.00', '300']))
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        site = query.get('site_no', query.get('sites', ['']))[0]
+        with server.lock:
+            server.calls.append((url.path, site))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            failures = server.fail.get(site, 0)
+            if failures:
+                server.fail[site] = failures - 1
+        try:
+            time.sleep(server.delay.get(site, server.default_delay))
+            if failures:
+                self.send_response(503)
+                self.end_headers()
+                return
+            if url.path.endswith('gwlevels'):
+                body = _rdb(site).encode()
+            elif url.path.endswith('site/'):
+                body = _site(site).encode()
+            else:
+                body = _inventory(site).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+@pytest.fixture
+def nwis(monkeypatch):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.calls, server.active, server.max_active = [], 0, 0
+    server.fail, server.delay, server.default_delay = {}, {}, 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    monkeypatch.setattr(constants, 'USGS_GWLEVELS_URL', base + '/nwis/gwlevels')
+    monkeypatch.setattr(constants, 'USGS_INVENTORY_URL', base + '/nwis/inventory')
+    monkeypatch.setattr(constants, 'USGS_SITE_URL', base + '/nwis/site/')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_cache_first_run_fetches(nwis, tmp_path):
+    payload, metadata = process_water.cached_usgs_water(WELLS[0], tmp_path)
+    assert len(nwis.calls) == 2
+    assert WELLS[0] in payload
+    assert metadata['wellname'] == WELLS[0]
+    assert tmp_path.joinpath(WELLS[0]).exists() and tmp_path.joinpath(WELLS[0] + '.json').exists()
+
+
+def test_cache_second_run_makes_no_request(nwis, tmp_path):
+    first = process_water.cached_usgs_water(WELLS[0], tmp_path, max_age=30)
+    nwis.calls.clear()
+    second = process_water.cached_usgs_water(WELLS[0], tmp_path, max_age=30)
+    water = process_water.format_usgs_water(WELLS[0], tmp_path, max_age=30)
+    assert nwis.calls == []
+    assert second[0] == first[0]
+    assert second[1].to_dict() == first[1].to_dict()
+    assert len(water) == 2
+
+
+def test_cache_expires_after_max_age(nwis, tmp_path):
+    process_water.cached_usgs_water(WELLS[0], tmp_path)
+    meta_path = tmp_path.joinpath(WELLS[0] + '.json')
+    record = json.loads(meta_path.read_text())
+    record['fetched'] -= 2 * 86400
+    meta_path.write_text(json.dumps(record))
+    nwis.calls.clear()
+    process_water.cached_usgs_water(WELLS[0], tmp_path, max_age=3)
+    assert nwis.calls == []
+    process_water.cached_usgs_water(WELLS[0], tmp_path, max_age=1)
+    assert len(nwis.calls) == 2
+    assert json.loads(meta_path.read_text())['fetched'] > record['fetched'] + 86400
+
+
+def test_cache_refresh_bypasses_cache(nwis, tmp_path):
+    process_water.cached_usgs_water(WELLS[0], tmp_path)
+    nwis.calls.clear()
+    process_water.cached_usgs_water(WELLS[0], tmp_path, refresh=True)
+    assert len(nwis.calls) == 2
+
+
+def _sites(n):
+    return ['3750061125548{:02d}'.format(i) for i in range(n)]
+
+
+def test_download_bounded_concurrency(nwis, tmp_path):
+    nwis.default_delay = 0.1
+    wells = _sites(12)
+    water = process_water.download_usgs_water(wells, tmp_path, workers=3)
+    assert len(water) == len(wells)
+    assert 1 < nwis.max_active <= 3
+
+
+def test_download_retries_transient_503(nwis, tmp_path):
+    wells = _sites(3)
+    nwis.fail[wells[1]] = 1
+    water = process_water.download_usgs_water(wells, tmp_path, workers=2, retries=2)
+    assert [frame.attrs['well_no'] for frame in water] == wells
+    gwlevels = [site for path, site in nwis.calls if path.endswith('gwlevels')]
+    assert gwlevels.count(wells[1]) == 2
+
+
+def test_download_skips_persistent_503(nwis, tmp_path):
+    wells = _sites(3)
+    nwis.fail[wells[1]] = 100
+    water = process_water.download_usgs_water(wells, tmp_path, workers=2, retries=2)
+    assert [frame.attrs['well_no'] for frame in water] == [wells[0], wells[2]]
+    gwlevels = [site for path, site in nwis.calls if path.endswith('gwlevels')]
+    assert gwlevels.count(wells[1]) == 3
+    assert not tmp_path.joinpath(wells[1]).exists()
+
+
+def test_download_times_out_on_stalled_response(nwis, tmp_path):
+    wells = _sites(3)
+    nwis.delay[wells[0]] = 5
+    start = time.monotonic()
+    water = process_water.download_usgs_water(wells, tmp_path, workers=3, retries=1, timeout=0.5)
+    assert time.monotonic() - start < 4
+    assert [frame.attrs['well_no'] for frame in water] == wells[1:]
+
+
+def test_download_keeps_input_order(nwis, tmp_path):
+    wells = _sites(8)
+    # later wells answer first
+    for i, well in enumerate(wells):
+        nwis.delay[well] = 0.05 * (len(wells) - i)
+    water = process_water.download_usgs_water(wells, tmp_path, workers=8)
+    assert [frame.attrs['well_no'] for frame in water] == wells
+    assert [frame['well_no'].iloc[0] for frame in water] == wells
+
+
+def test_split_rdb_per_site(nwis):
+    wells = _sites(3)
+    payloads = process_water.split_rdb(process_water.fetch_gwlevels(wells))
+    assert list(payloads) == wells
+    for well, payload in payloads.items():
+        levels = process_water.read_rdb(payload)
+        assert list(levels['site_no']) == [well, well]
+
+
+def test_batch_metadata_matches_single_download(nwis, tmp_path):
+    wells = _sites(3)
+    single = process_water.download_usgs_water(wells, tmp_path.joinpath('single'), workers=2)
+    batched = process_water.download_usgs_water(wells, tmp_path.joinpath('batch'), workers=2, batch_size=3)
+    assert [path for path, site in nwis.calls if path.endswith('site/')] == ['/nwis/site/']
+    for one, many in zip(single, batched):
+        assert one.attrs.keys() == many.attrs.keys()
+        for key, value in one.attrs.items():
+            assert many.attrs[key] == (pytest.approx(value) if isinstance(value, float) else value), key
+        assert one.attrs['wellname'] == one.attrs['well_no']
+        assert one.attrs['crs'] == 'EPSG:4326'
+    lon, lat = Transformer.from_crs('EPSG:4267', 'EPSG:4326', always_xy=True).transform(-112.93, 37.835)
+    assert single[0].attrs['lon'] == pytest.approx(lon) and single[0].attrs['lat'] == pytest.approx(lat)
+
+
+def test_batch_failure_falls_back_to_single_wells(nwis, tmp_path):
+    wells = _sites(3)
+    nwis.fail[','.join(wells)] = 100
+    water = process_water.download_usgs_water(wells, tmp_path, workers=2, retries=1, batch_size=3)
+    assert [frame.attrs['well_no'] for frame in water] == wells
+    gwlevels = [site for path, site in nwis.calls if path.endswith('gwlevels')]
+    assert gwlevels.count(','.join(wells)) == 2
+    assert sorted(site for site in gwlevels if ',' not in site) == wells